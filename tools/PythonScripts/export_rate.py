@@ -5,13 +5,21 @@
 
     支持CTPAPI接口的柜台均可导出
 
-    需先安装 openctp-ctp: pip install openctp-ctp
+    需先安装 openctp-ctp 和 numpy: pip install openctp-ctp numpy
 """
 
+import datetime
+import json
+import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from operator import attrgetter, itemgetter
 from pathlib import Path
-from queue import Queue
+from typing import Callable, Optional
 
+import numpy as np
 from openctp_ctp import tdapi
 
 # 以下信息默认为 simnow 环境，需要按照各自柜台进行配置。
@@ -24,11 +32,253 @@ td_front = "tcp://180.168.146.187:10130"
 broker_id = "9999"
 authcode = "0000000000000000"
 appid = "simnow_client_test"
+# 查询流控: 每秒查询数, 在途(已发送未返回)查询数上限, 柜台返回-2时自动降为柜台允许的在途数量
+qry_rate = 5.0
+qry_in_flight = 4
+# 查询超时秒数, 超时未返回的查询按无结果处理
+qry_timeout = 10.0
+# 费率缓存文件, 同一交易日再次导出时只查询缓存中没有的合约, 为空时不使用缓存
+rate_cache = "rate_cache.json"
+# 费率缓存保留的天数, 更早交易日的缓存在保存时淘汰
+rate_cache_days = 7
+# 品种最近的两个合约和最远合约的保证金率相同时, 其它合约使用相同的保证金率而不再逐个查询;
+# 柜台对个别合约(如交割月、临近交割月)单独设置保证金率时推断结果会出错, 默认关闭
+infer_margin = False
+
+
+class QueryScheduler(object):
+    """
+    令牌桶限速的查询调度器
+        按 qry_rate 发放令牌, 在途查询数不超过柜台允许的数量, 响应按 nRequestID 匹配到对应的查询,
+        因此不需要等上一个查询返回才发送下一个, 也不依赖响应的先后顺序
+    """
+
+    # 未处理请求超过许可数
+    TOO_MANY_PENDING = -2
+    # 每秒发送请求数超过许可数
+    TOO_MANY_PER_SECOND = -3
+
+    def __init__(self, spi: "CTdSpi", rate: float, in_flight: int, timeout: float):
+        self._spi = spi
+        self._rate = rate
+        self._window = max(1, in_flight)
+        self._timeout = timeout
+
+    def run(
+        self,
+        tasks: deque,
+        send: Callable[[object, int], int],
+        done: Callable[[object, list[dict]], None],
+    ):
+        """
+        发送 tasks 中的全部查询, send(task, request_id) 发送一个查询并返回 ReqQry 的返回值,
+        done(task, records) 在查询的最后一条响应到达时调用, 可以向 tasks 追加新的查询,
+        发送失败或超时时 records 为 None
+        """
+        pending = {}  # type: dict[Future, tuple[object, float]]
+        tokens, stamp = 1.0, time.monotonic()
+        while tasks or pending:
+            now = time.monotonic()
+            tokens = min(1.0, tokens + (now - stamp) * self._rate)
+            stamp = now
+
+            while tasks and len(pending) < self._window and tokens >= 1:
+                task = tasks.popleft()
+                ret, future = self._spi.request(lambda request_id: send(task, request_id))
+                if ret == 0:
+                    tokens -= 1
+                    pending[future] = (task, now)
+                    continue
+                if ret == self.TOO_MANY_PENDING:
+                    self._window = max(1, len(pending))
+                    tasks.appendleft(task)
+                elif ret == self.TOO_MANY_PER_SECOND:
+                    tasks.appendleft(task)
+                else:
+                    print(f"\t发送查询失败: ret={ret}, {task}")
+                    done(task, None)
+                # 流控时等待下一个令牌再重试
+                tokens = 0.0
+                break
+
+            # 等待响应, 还可以发送时最多等到下一个令牌
+            timeout = self._timeout
+            if tasks and len(pending) < self._window:
+                timeout = (1 - tokens) / self._rate
+            if pending:
+                finished, _ = wait(pending, timeout=max(timeout, 0.001), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    task, _ = pending.pop(future)
+                    done(task, None if future.exception() else future.result())
+            else:
+                time.sleep(max(timeout, 0.001))
+
+            now = time.monotonic()
+            for future, (task, sent) in list(pending.items()):
+                if now - sent > self._timeout:
+                    print(f"\t查询超时: {task}")
+                    del pending[future]
+                    future.cancel()
+                    done(task, None)
+
+
+class RateCache(object):
+    """
+    费率查询结果的持久化缓存
+        按 (经纪商, 投资者, 交易日) 分组, 组内按 (查询类型, 合约) 保存查询返回的记录,
+        超过 ttl_days 天的交易日在保存时淘汰
+    """
+
+    def __init__(self, path: str, broker: str, investor: str, trading_day: str, ttl_days: int):
+        self._path = path
+        self._trading_day = trading_day
+        self._ttl_days = ttl_days
+        self._data = {}  # type: dict[str, dict[str, dict[str, list[dict]]]]
+        if os.path.exists(path):
+            with open(path, encoding="utf8") as fp:
+                self._data = json.load(fp)
+        self._day = self._data.setdefault(f"{broker}/{investor}/{trading_day}", {})
+        self.hits = 0
+
+    def get(self, kind: str, inst_id: str) -> Optional[list[dict]]:
+        records = self._day.get(kind, {}).get(inst_id)
+        if records is not None:
+            self.hits += 1
+        return records
+
+    def put(self, kind: str, inst_id: str, records: list[dict]):
+        self._day.setdefault(kind, {})[inst_id] = records
 
-Q_INSTRUMENT = Queue()  # type: Queue[dict]
-Q_RATE = Queue()  # type: Queue[dict|None]
-Q_MARKET = Queue()  # type: Queue[dict]
-Q_MARGIN = Queue()  # type: Queue[dict|None]
+    def save(self):
+        today = datetime.datetime.strptime(self._trading_day, "%Y%m%d")
+        for key in list(self._data):
+            day = datetime.datetime.strptime(key.rsplit("/", 1)[1], "%Y%m%d")
+            if (today - day).days > self._ttl_days:
+                del self._data[key]
+        tmp = self._path + ".tmp"
+        with open(tmp, mode="w", encoding="utf8") as fp:
+            json.dump(self._data, fp, ensure_ascii=False)
+        os.replace(tmp, self._path)
+
+
+class MarketSnapshot(object):
+    """
+    行情快照
+        每个合约占一行, 同类型的字段存放在预分配的 numpy 数组中, 行数不足时按倍数扩容,
+        index 记录合约所在的行, 之后的计算、导出或查找都按行号关联, 不再生成中间的 dict
+    """
+
+    FLOAT_FIELDS = (
+        "LastPrice",
+        "PreSettlementPrice",
+        "PreClosePrice",
+        "PreOpenInterest",
+        "OpenPrice",
+        "HighestPrice",
+        "LowestPrice",
+        "Turnover",
+        "OpenInterest",
+        "ClosePrice",
+        "SettlementPrice",
+        "UpperLimitPrice",
+        "LowerLimitPrice",
+        "PreDelta",
+        "CurrDelta",
+        "BidPrice1",
+        "AskPrice1",
+        "BidPrice2",
+        "AskPrice2",
+        "BidPrice3",
+        "AskPrice3",
+        "BidPrice4",
+        "AskPrice4",
+        "BidPrice5",
+        "AskPrice5",
+        "AveragePrice",
+    )
+    INT_FIELDS = (
+        "Volume",
+        "UpdateMillisec",
+        "BidVolume1",
+        "AskVolume1",
+        "BidVolume2",
+        "AskVolume2",
+        "BidVolume3",
+        "AskVolume3",
+        "BidVolume4",
+        "AskVolume4",
+        "BidVolume5",
+        "AskVolume5",
+    )
+    TEXT_FIELDS = (
+        "InstrumentID",
+        "ExchangeID",
+        "TradingDay",
+        "ActionDay",
+        "UpdateTime",
+    )
+
+    _get_float = attrgetter(*FLOAT_FIELDS)
+    _get_int = attrgetter(*INT_FIELDS)
+    _get_text = attrgetter(*TEXT_FIELDS)
+
+    def __init__(self, capacity: int = 1024):
+        self.index = {}  # type: dict[str, int]
+        self._floats = np.zeros((capacity, len(self.FLOAT_FIELDS)), dtype=np.float64)
+        self._ints = np.zeros((capacity, len(self.INT_FIELDS)), dtype=np.int64)
+        self._texts = np.empty((capacity, len(self.TEXT_FIELDS)), dtype=object)
+        self._columns = {}  # type: dict[str, tuple[np.ndarray, int]]
+        for fields, name in (
+            (self.FLOAT_FIELDS, "_floats"),
+            (self.INT_FIELDS, "_ints"),
+            (self.TEXT_FIELDS, "_texts"),
+        ):
+            for i, field in enumerate(fields):
+                self._columns[field] = (name, i)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def update(self, pDepthMarketData: tdapi.CThostFtdcDepthMarketDataField) -> int:
+        """写入一个合约的行情, 返回所在的行"""
+        row = self.index.get(pDepthMarketData.InstrumentID)
+        if row is None:
+            row = len(self.index)
+            if row == len(self._floats):
+                self._grow()
+            self.index[pDepthMarketData.InstrumentID] = row
+        self._floats[row] = self._get_float(pDepthMarketData)
+        self._ints[row] = self._get_int(pDepthMarketData)
+        self._texts[row] = self._get_text(pDepthMarketData)
+        return row
+
+    def _grow(self):
+        capacity = len(self._floats) * 2
+        for name in ("_floats", "_ints", "_texts"):
+            values = getattr(self, name)
+            grown = np.zeros((capacity, values.shape[1]), dtype=values.dtype)
+            grown[: len(values)] = values
+            setattr(self, name, grown)
+
+    def rows(self, inst_ids: list[str]) -> np.ndarray:
+        """合约所在的行, 没有行情的合约为 -1"""
+        get = self.index.get
+        return np.fromiter((get(inst_id, -1) for inst_id in inst_ids), dtype=np.int64, count=len(inst_ids))
+
+    def column(self, field: str) -> np.ndarray:
+        """字段的全部已写入的值, 与行号对应"""
+        name, i = self._columns[field]
+        return getattr(self, name)[: len(self.index), i]
+
+    def get(self, inst_id: str) -> Optional[dict]:
+        """单个合约的全部字段"""
+        row = self.index.get(inst_id)
+        if row is None:
+            return None
+        record = dict(zip(self.TEXT_FIELDS, self._texts[row].tolist()))
+        record.update(zip(self.FLOAT_FIELDS, self._floats[row].tolist()))
+        record.update(zip(self.INT_FIELDS, self._ints[row].tolist()))
+        return record
 
 
 class CTdSpi(tdapi.CThostFtdcTraderSpi):
@@ -53,14 +303,21 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
         self._api.RegisterSpi(self)
         self._api.SubscribePrivateTopic(tdapi.THOST_TERT_QUICK)
         self._api.SubscribePublicTopic(tdapi.THOST_TERT_QUICK)
-        self._api.Init()
 
         self.is_login = None
+        # 登录结果, 认证或登录失败时为 False
+        self.login = Future()  # type: Future[bool]
         self.trading_day = ""
         self.session_id = ""
         self.sys_version = ""
-        self.last_instrument = False
-        self.last_market_data = False
+        self._lock = threading.Lock()
+        self._request_id = 0
+        self._futures = {}  # type: dict[int, Future]
+        self._responses = {}  # type: dict[int, list[dict]]
+        # 行情查询的结果直接写入快照
+        self.market = MarketSnapshot()
+        # 回调可能在 Init 返回前到达, 所有状态需在此之前创建
+        self._api.Init()
 
     def release(self):
         self._api.Release()
@@ -69,6 +326,48 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
     def api(self):
         return self._api
 
+    def request(self, send: Callable[[int], int]) -> tuple[int, Future]:
+        """
+        分配 nRequestID 并调用 send(request_id) 发送请求,
+        返回 ReqQry 的返回值和在最后一条响应到达时以全部记录完成的 Future
+        """
+        future = Future()
+        with self._lock:
+            self._request_id += 1
+            request_id = self._request_id
+            self._futures[request_id] = future
+        ret = send(request_id)
+        if ret != 0:
+            with self._lock:
+                self._futures.pop(request_id, None)
+            future.cancel()
+        return ret, future
+
+    def _collect(self, nRequestID: int, record: Optional[dict], bIsLast: bool):
+        """按 nRequestID 收集响应, 最后一条到达时完成对应的 Future"""
+        if record is not None:
+            self._responses.setdefault(nRequestID, []).append(record)
+        if bIsLast:
+            records = self._responses.pop(nRequestID, [])
+            with self._lock:
+                future = self._futures.pop(nRequestID, None)
+            if future is not None and not future.done():
+                future.set_result(records)
+
+    def _fail(self, nRequestID: int, error: Exception):
+        """查询返回错误时以异常完成对应的 Future, 已收到的记录一并丢弃"""
+        self._responses.pop(nRequestID, None)
+        with self._lock:
+            future = self._futures.pop(nRequestID, None)
+        if future is not None and not future.done():
+            future.set_exception(error)
+
+    def _set_login(self, ok: bool):
+        self.is_login = ok
+        # 断线重连后会再次登录, 只记录第一次的结果
+        if not self.login.done():
+            self.login.set_result(ok)
+
     def OnFrontConnected(self):
         req = tdapi.CThostFtdcReqAuthenticateField()
         req.BrokerID = broker_id
@@ -79,6 +378,13 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
 
     def OnFrontDisconnected(self, nReason: int):
         print("交易前置连接断开: nReason=", nReason)
+        # 断开前未返回的查询不会再有响应
+        with self._lock:
+            futures, self._futures = self._futures, {}
+        self._responses.clear()
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"交易前置连接断开: nReason={nReason}"))
 
     def OnRspAuthenticate(
         self,
@@ -89,6 +395,7 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
     ):
         if pRspInfo and pRspInfo.ErrorID:
             print(f"认证失败: ErrorID={pRspInfo.ErrorID}, ErrorMsg={pRspInfo.ErrorMsg}")
+            self._set_login(False)
             return
 
         if pRspInfo is None or pRspInfo.ErrorID == 0:
@@ -109,13 +416,13 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
     ):
         if pRspInfo and pRspInfo.ErrorID:
             # print(f"登录失败: ErrorID={pRspInfo.ErrorID}, ErrorMsg={pRspInfo.ErrorMsg}")
-            self.is_login = False
+            self._set_login(False)
             return
 
-        self.is_login = True
         self.trading_day = pRspUserLogin.TradingDay
         self.session_id = pRspUserLogin.SessionID
         self.sys_version = pRspUserLogin.SysVersion
+        self._set_login(True)
 
     def OnRspQryInstrument(
         self,
@@ -124,23 +431,22 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
         nRequestID: int,
         bIsLast: bool,
     ):
+        record = None
         if pRspInfo and pRspInfo.ErrorID:
             print(f"查询合约失败: ErrorID={pRspInfo.ErrorID}, ErrorMsg={pRspInfo.ErrorMsg}")
         elif pInstrument:
             if pInstrument.ProductClass == tdapi.THOST_FTDC_PC_Futures:
-                Q_INSTRUMENT.put_nowait(
-                    {
-                        "ExchangeID": pInstrument.ExchangeID,
-                        "InstrumentID": pInstrument.InstrumentID,
-                        "InstrumentName": pInstrument.InstrumentName,
-                        "ProductID": pInstrument.ProductID,
-                        "VolumeMultiple": pInstrument.VolumeMultiple,
-                        "PriceTick": pInstrument.PriceTick,
-                    }
-                )
+                record = {
+                    "ExchangeID": pInstrument.ExchangeID,
+                    "InstrumentID": pInstrument.InstrumentID,
+                    "InstrumentName": pInstrument.InstrumentName,
+                    "ProductID": pInstrument.ProductID,
+                    "VolumeMultiple": pInstrument.VolumeMultiple,
+                    "PriceTick": pInstrument.PriceTick,
+                    "ExpireDate": pInstrument.ExpireDate,
+                }
 
-        if bIsLast:
-            self.last_instrument = True
+        self._collect(nRequestID, record, bIsLast)
 
     def OnRspQryInstrumentCommissionRate(
         self,
@@ -153,11 +459,13 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
             print(
                 f"\t查询合约手续费失败: ErrorID={pRspInfo.ErrorID}, ErrorMsg={pRspInfo.ErrorMsg}"
             )
+            self._fail(nRequestID, RuntimeError(f"查询合约手续费失败: ErrorID={pRspInfo.ErrorID}"))
             return
 
         # print(f"查询合约手续费率响应成功: InstrumentID={pInstrumentCommissionRate.InstrumentID}")
         if pInstrumentCommissionRate:
-            Q_RATE.put_nowait(
+            self._collect(
+                nRequestID,
                 {
                     "ExchangeID": pInstrumentCommissionRate.ExchangeID,
                     "InstrumentID": pInstrumentCommissionRate.InstrumentID,
@@ -167,10 +475,11 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
                     "CloseRatioByVolume": pInstrumentCommissionRate.CloseRatioByVolume,
                     "CloseTodayRatioByMoney": pInstrumentCommissionRate.CloseTodayRatioByMoney,
                     "CloseTodayRatioByVolume": pInstrumentCommissionRate.CloseTodayRatioByVolume,
-                }
+                },
+                bIsLast,
             )
         else:
-            Q_RATE.put_nowait(None)
+            self._collect(nRequestID, None, bIsLast)
 
     def OnRspQryInstrumentMarginRate(
         self,
@@ -183,10 +492,12 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
             print(
                 f"\t查询合约保证金失败: ErrorID={pRspInfo.ErrorID}, ErrorMsg={pRspInfo.ErrorMsg}"
             )
+            self._fail(nRequestID, RuntimeError(f"查询合约保证金失败: ErrorID={pRspInfo.ErrorID}"))
             return
 
         if pInstrumentMarginRate:
-            Q_MARGIN.put_nowait(
+            self._collect(
+                nRequestID,
                 {
                     "InstrumentID": pInstrumentMarginRate.InstrumentID,
                     "ExchangeID": pInstrumentMarginRate.ExchangeID,
@@ -194,10 +505,11 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
                     "LongMarginRatioByVolume": pInstrumentMarginRate.LongMarginRatioByVolume,
                     "ShortMarginRatioByMoney": pInstrumentMarginRate.ShortMarginRatioByMoney,
                     "ShortMarginRatioByVolume": pInstrumentMarginRate.ShortMarginRatioByVolume,
-                }
+                },
+                bIsLast,
             )
         else:
-            Q_MARGIN.put_nowait(None)
+            self._collect(nRequestID, None, bIsLast)
 
     def OnRspQryDepthMarketData(
         self,
@@ -214,189 +526,303 @@ class CTdSpi(tdapi.CThostFtdcTraderSpi):
                 pRspInfo.ErrorMsg,
             )
         elif pDepthMarketData:
-            Q_MARKET.put_nowait(
-                {
-                    "ExchangeID": pDepthMarketData.ExchangeID,
-                    "InstrumentID": pDepthMarketData.InstrumentID,
-                    "LastPrice": pDepthMarketData.LastPrice,
-                    "Volume": pDepthMarketData.Volume,
-                    "OpenInterest": pDepthMarketData.OpenInterest,
-                }
-            )
+            self.market.update(pDepthMarketData)
 
-        if bIsLast:
-            self.last_market_data = True
+        self._collect(nRequestID, None, bIsLast)
 
 
 class Export(object):
+    COMMISSION = "commission"
+    MARGIN = "margin"
+    MARGIN_FIELDS = (
+        "LongMarginRatioByMoney",
+        "LongMarginRatioByVolume",
+        "ShortMarginRatioByMoney",
+        "ShortMarginRatioByVolume",
+    )
+    # 按金额、按手数交替排列, 依次为开仓、平仓、平今仓
+    RATE_FIELDS = (
+        "OpenRatioByMoney",
+        "OpenRatioByVolume",
+        "CloseRatioByMoney",
+        "CloseRatioByVolume",
+        "CloseTodayRatioByMoney",
+        "CloseTodayRatioByVolume",
+    )
+
     def __init__(self):
-        self._spi = CTdSpi()
+        self._spi = None  # type: Optional[CTdSpi]
         self._d_instrument = {}
-        self._d_market_data = {}
+        self._market = None  # type: Optional[MarketSnapshot]
         self._d_rate = {}
         self._d_margin = {}
 
-    def run(self):
-        print("-------------------------- 启动CTP交易费导出工具")
-        print("CTPAPI:", self._spi.api.GetApiVersion())
-        print("交易前置:", td_front)
-
-        while self._spi.is_login is None:
-            time.sleep(1)
-
-        if not self._spi.is_login:
-            print("登录失败")
-            exit(-1)
-
-        print("交易后台版本:", self._spi.sys_version)
-        print("交易日:", self._spi.trading_day)
-        print("投资者:", user)
+    def run(self) -> bool:
+        """登录并导出一次交易费, 每次运行使用新的连接, 同一个 Export 可以多次运行"""
+        self._spi = CTdSpi()
+        self._d_instrument = {}
+        self._market = None  # type: Optional[MarketSnapshot]
+        self._d_rate = {}
+        self._d_margin = {}
 
-        _t_start = time.time()
-        print("-------------------------- 开始导出CTP交易费")
-        self.query_instrument()
-        self.query_market_data()
-        self.query_rate()
-        self.save()
+        # 查询超时、断线等异常时也要释放API, 否则连接和API线程会一直保留
+        try:
+            print("-------------------------- 启动CTP交易费导出工具")
+            print("CTPAPI:", self._spi.api.GetApiVersion())
+            print("交易前置:", td_front)
+
+            if not self._spi.login.result():
+                print("登录失败")
+                return False
+
+            print("交易后台版本:", self._spi.sys_version)
+            print("交易日:", self._spi.trading_day)
+            print("投资者:", user)
+
+            _t_start = time.time()
+            print("-------------------------- 开始导出CTP交易费")
+            self.query_instrument()
+            self.query_market_data()
+            self.query_rate()
+            self.save()
+        finally:
+            self.release()
 
-        self.release()
         _t = int(time.time() - _t_start)
         print("-------------------------- 导出CTP交易费完成:", _t, "秒")
+        return True
 
     def release(self):
         self._spi.release()
 
+    def _query(self, send: Callable[[int], int]) -> list[dict]:
+        """发送一个查询并等待最后一条响应, 流控时按 qry_rate 重试"""
+        while True:
+            ret, future = self._spi.request(send)
+            if ret == 0:
+                return future.result()
+            if ret not in (QueryScheduler.TOO_MANY_PENDING, QueryScheduler.TOO_MANY_PER_SECOND):
+                raise RuntimeError(f"发送查询失败: ret={ret}")
+            time.sleep(1 / qry_rate)
+
     def query_instrument(self):
         print("1. 查询合约")
         req = tdapi.CThostFtdcQryInstrumentField()
         req.BrokerID = broker_id
         req.InvestorID = user
-        self._spi.api.ReqQryInstrument(req, 0)
+        instruments = self._query(lambda request_id: self._spi.api.ReqQryInstrument(req, request_id))
 
-        while not self._spi.last_instrument:
-            time.sleep(1)
+        print("\t合约数量:", len(instruments))
 
-        print("\t合约数量:", Q_INSTRUMENT.qsize())
-
-        while Q_INSTRUMENT.qsize():
-            ins = Q_INSTRUMENT.get()
+        for ins in instruments:
             self._d_instrument[ins["InstrumentID"]] = ins
 
     def query_market_data(self):
         print("2. 查询行情")
         req = tdapi.CThostFtdcQryDepthMarketDataField()
-        self._spi.api.ReqQryDepthMarketData(req, 0)
-
-        while not self._spi.last_market_data:
-            time.sleep(1)
+        self._query(lambda request_id: self._spi.api.ReqQryDepthMarketData(req, request_id))
+        self._market = self._spi.market
 
-        while Q_MARKET.qsize():
-            market = Q_MARKET.get()
-            if market["InstrumentID"] in self._d_instrument:
-                self._d_market_data[market["InstrumentID"]] = market
-
-        print("\t行情数量:", len(self._d_market_data))
+        rows = self._market.rows(list(self._d_instrument))
+        print("\t行情数量:", int(np.count_nonzero(rows >= 0)))
 
     def query_rate(self):
         print("3. 查询交易费率")
+        cache = None
+        if rate_cache:
+            cache = RateCache(rate_cache, broker_id, user, self._spi.trading_day, rate_cache_days)
+
+        # 手续费按品种查询, 柜台返回的是合约的手续费率时再查询该品种的其它合约
+        products = {}  # type: dict[str, list[str]]
         for inst_id, ins in self._d_instrument.items():
-            if ins["ProductID"] not in self._d_rate:
-                req = tdapi.CThostFtdcQryInstrumentCommissionRateField()
-                req.BrokerID = broker_id
-                req.InvestorID = user
-                req.InstrumentID = inst_id
-                while True:
-                    ret = self._spi.api.ReqQryInstrumentCommissionRate(req, 0)
-                    if ret == 0:
-                        time.sleep(0.2)
-                        break
-                    time.sleep(0.1)
-                    print("sleep 0.1")
-
-                rate = Q_RATE.get()
-                if rate is None:
-                    continue
+            products.setdefault(ins["ProductID"], []).append(inst_id)
+        # 保证金先查询品种到期最近的两个合约和最远的合约, 都相同时推断其它合约与之相同
+        probes = {}  # type: dict[str, list[str]]
+        for product_id, inst_ids in products.items():
+            months = sorted(inst_ids, key=lambda inst_id: (self._d_instrument[inst_id]["ExpireDate"], inst_id))
+            probes[product_id] = list(dict.fromkeys(months[:2] + months[-1:])) if infer_margin else inst_ids
+        inferred = []
+
+        tasks = deque()
+
+        def enqueue(task: tuple[str, str]):
+            records = cache.get(*task) if cache else None
+            if records is None:
+                tasks.append(task)
+            else:
+                done(task, records)
+
+        def queried(task: tuple[str, str], records: Optional[list[dict]]):
+            # 查询失败或超时时 records 为 None, 不写入缓存, 下次运行重新查询
+            if cache and records is not None:
+                cache.put(*task, records)
+            done(task, records or [])
+
+        def done(task: tuple[str, str], records: list[dict]):
+            kind, inst_id = task
+            product_id = self._d_instrument[inst_id]["ProductID"]
+            if kind == self.MARGIN:
+                self._d_margin[inst_id] = records[0] if records else None
+                if infer_margin and inst_id in probes[product_id]:
+                    self._resolve_margin(products[product_id], probes[product_id], enqueue, inferred)
+                return
+            for rate in records:
                 self._d_rate[rate["InstrumentID"]] = rate
+            if product_id not in self._d_rate and products[product_id][0] == inst_id:
+                for other in products[product_id][1:]:
+                    enqueue((self.COMMISSION, other))
+
+        # 手续费和保证金查询交替排队
+        for product_id, inst_ids in products.items():
+            enqueue((self.COMMISSION, inst_ids[0]))
+            for inst_id in probes[product_id]:
+                enqueue((self.MARGIN, inst_id))
+
+        scheduler = QueryScheduler(self._spi, qry_rate, qry_in_flight, qry_timeout)
+        scheduler.run(tasks, self._send_rate_query, queried)
+        if cache:
+            cache.save()
+            print("\t缓存命中:", cache.hits)
+
+        print("\t手续费数量:", len(self._d_rate))
+        print("\t保证金数量:", len(self._d_margin))
+        print("\t推断保证金数量:", len(inferred))
 
-            req = tdapi.CThostFtdcQryInstrumentMarginRateField()
+    def _resolve_margin(
+        self,
+        inst_ids: list[str],
+        probes: list[str],
+        enqueue: Callable[[tuple[str, str]], None],
+        inferred: list[str],
+    ):
+        """品种的探测合约都返回后, 保证金率相同则推断其它合约, 否则逐个查询其它合约"""
+        if any(inst_id not in self._d_margin for inst_id in probes):
+            return
+        margins = [self._d_margin[inst_id] for inst_id in probes]
+        same = all(margins) and all(
+            all(margin[field] == margins[0][field] for field in self.MARGIN_FIELDS)
+            for margin in margins
+        )
+        others = [inst_id for inst_id in inst_ids if inst_id not in probes]
+        if same and others:
+            # 逐个品种输出推断的合约, 便于核对导出结果
+            print(f"\t推断保证金: {', '.join(others)} 同 {', '.join(probes)}")
+        for inst_id in others:
+            if same:
+                self._d_margin[inst_id] = dict(margins[0], InstrumentID=inst_id)
+                inferred.append(inst_id)
+            else:
+                enqueue((self.MARGIN, inst_id))
+
+    def _send_rate_query(self, task: tuple[str, str], request_id: int) -> int:
+        kind, inst_id = task
+        if kind == self.COMMISSION:
+            req = tdapi.CThostFtdcQryInstrumentCommissionRateField()
             req.BrokerID = broker_id
             req.InvestorID = user
-            req.HedgeFlag = tdapi.THOST_FTDC_HF_Speculation
             req.InstrumentID = inst_id
-            while True:
-                ret = self._spi.api.ReqQryInstrumentMarginRate(req, 0)
-                if ret == 0:
-                    time.sleep(0.2)
-                    break
-                time.sleep(0.1)
-                print("sleep 0.1")
-
-            margin = Q_MARGIN.get()
-            self._d_margin[inst_id] = margin
+            return self._spi.api.ReqQryInstrumentCommissionRate(req, request_id)
 
-        print("\t手续费数量:", len(self._d_rate))
-        print("\t保证金数量:", len(self._d_margin))
+        req = tdapi.CThostFtdcQryInstrumentMarginRateField()
+        req.BrokerID = broker_id
+        req.InvestorID = user
+        req.HedgeFlag = tdapi.THOST_FTDC_HF_Speculation
+        req.InstrumentID = inst_id
+        return self._spi.api.ReqQryInstrumentMarginRate(req, request_id)
 
     def save(self):
         print("4. 计算交易费并导出")
         header = "交易所,合约,合约名称,品种,合约乘数,开仓费率,开仓费/手,平仓费率,平仓费/手,平今仓费率,平今仓费/手,最新价,成交量,空盘量,1手开仓手续费,1手平仓手续费,1手平今仓手续费,做多保证金率,做多保证金/手,做空保证金率,做空保证金/手,做多1手保证金,做空1手保证金,最小跳动价位,1Tick盈亏\n"
-        valid_lines, invalid_lines = [header], [header]
-        for ins_id, ins in self._d_instrument.items():
-            multiple = ins["VolumeMultiple"]
-            line = [
-                ins["ExchangeID"],
-                ins_id,
-                ins["InstrumentName"],
-                ins["ProductID"],
-                str(multiple),
-            ]
-            market = self._d_market_data.get(ins_id, {})
-            rate = self._d_rate.get(ins_id, {}) or self._d_rate.get(
-                ins["ProductID"], {}
-            )
-            margin = self._d_margin.get(ins["InstrumentID"])
 
-            if not market or not rate or not margin:
-                invalid_lines.append(",".join(line) + "\n")
-                continue
-
-            last_price = market.get("LastPrice", 0)
-            open_money = rate.get("OpenRatioByMoney")
-            open_volume = rate.get("OpenRatioByVolume")
-            close_money = rate.get("CloseRatioByMoney")
-            close_volume = rate.get("CloseRatioByVolume")
-            close_today_money = rate.get("CloseTodayRatioByMoney")
-            close_today_volume = rate.get("CloseTodayRatioByVolume")
-            long_money = margin.get("LongMarginRatioByMoney")
-            long_volume = margin.get("LongMarginRatioByVolume")
-            short_money = margin.get("ShortMarginRatioByMoney")
-            short_volume = margin.get("ShortMarginRatioByVolume")
-            line.extend(
-                [
-                    f"{open_money:f}",
-                    str(open_volume),
-                    f"{close_money:f}",
-                    str(close_volume),
-                    f"{close_today_money:f}",
-                    str(close_today_volume),
-                    str(last_price),
-                    str(market["Volume"]),
-                    str(market["OpenInterest"]),
-                    str(last_price * multiple * open_money + open_volume),
-                    str(last_price * multiple * close_money + close_volume),
-                    str(last_price * multiple * close_today_money + close_today_volume),
-                    str(long_money),
-                    str(long_volume),
-                    str(short_money),
-                    str(short_volume),
-                    str(last_price * multiple * long_money + long_volume),
-                    str(last_price * multiple * short_money + short_volume),
-                    str(ins["PriceTick"]),
-                    str(round(ins["PriceTick"] * multiple, 2)),
-                ]
-            )
-
-            valid_lines.append(",".join(line) + "\n")
+        # 按合约顺序收集有效合约的各项数据, 缺少行情、手续费或保证金的合约为无效合约
+        instruments = list(self._d_instrument.values())
+        market_rows = self._market.rows([ins["InstrumentID"] for ins in instruments])
+        get_rate = itemgetter(*self.RATE_FIELDS)
+        get_margin = itemgetter(*self.MARGIN_FIELDS)
+        valid_index, rates, margins = [], [], []
+        for i, (ins, row) in enumerate(zip(instruments, market_rows.tolist())):
+            rate = self._d_rate.get(ins["InstrumentID"]) or self._d_rate.get(ins["ProductID"])
+            margin = self._d_margin.get(ins["InstrumentID"])
+            if row >= 0 and rate and margin:
+                valid_index.append(i)
+                rates.append(get_rate(rate))
+                margins.append(get_margin(margin))
+
+        valid = np.zeros(len(instruments), dtype=bool)
+        valid[valid_index] = True
+        multiple = np.array([ins["VolumeMultiple"] for ins in instruments], dtype=np.int64)
+        price_tick = np.array([ins["PriceTick"] for ins in instruments], dtype=np.float64)
+        rate = np.array(rates, dtype=np.float64).reshape(-1, len(self.RATE_FIELDS))
+        margin = np.array(margins, dtype=np.float64).reshape(-1, len(self.MARGIN_FIELDS))
+
+        # 按行号从行情快照中取出有效合约的行情
+        market_rows = market_rows[valid]
+        last_price = self._market.column("LastPrice")[market_rows]
+        volume = self._market.column("Volume")[market_rows]
+        open_interest = self._market.column("OpenInterest")[market_rows]
+        # 1手合约价值 x 按金额费率 + 按手数费率, 运算顺序与逐个合约计算时相同;
+        # 无成交的合约最新价为 DBL_MAX, 结果为 inf/nan, 与逐个合约计算时一致, 不提示溢出
+        with np.errstate(over="ignore", invalid="ignore"):
+            notional = last_price * multiple[valid]
+            fee = notional[:, None] * rate[:, 0::2] + rate[:, 1::2]
+            margin_per_lot = notional[:, None] * margin[:, 0::2] + margin[:, 1::2]
+
+        def formatted(values: np.ndarray, fmt: Callable[[object], str]) -> list[str]:
+            # 费率、保证金率等列的取值大量重复, 每个不同的值只格式化一次;
+            # np.unique 把 -0.0 与 0.0 视为同一个值, 先统一为 0.0
+            if values.dtype.kind == "f":
+                values = values + 0.0
+            unique, inverse = np.unique(values, return_inverse=True)
+            strings = np.array(list(map(fmt, unique.tolist())), dtype=object)
+            return strings[inverse].tolist()
+
+        def text(values: np.ndarray) -> list[str]:
+            # float/int 的 repr 与 str 相同, 但转换更快
+            return formatted(values, repr)
+
+        def ratio(values: np.ndarray) -> list[str]:
+            return formatted(values, "{:f}".format)
+
+        base = [
+            [ins["ExchangeID"] for ins in instruments],
+            [ins["InstrumentID"] for ins in instruments],
+            [ins["InstrumentName"] for ins in instruments],
+            [ins["ProductID"] for ins in instruments],
+            text(multiple),
+        ]
+        invalid_index = np.flatnonzero(~valid).tolist()
+        columns = [[column[i] for i in valid_index] for column in base]
+        columns.extend(
+            [
+                ratio(rate[:, 0]),
+                text(rate[:, 1]),
+                ratio(rate[:, 2]),
+                text(rate[:, 3]),
+                ratio(rate[:, 4]),
+                text(rate[:, 5]),
+                text(last_price),
+                text(volume),
+                text(open_interest),
+                text(fee[:, 0]),
+                text(fee[:, 1]),
+                text(fee[:, 2]),
+                text(margin[:, 0]),
+                text(margin[:, 1]),
+                text(margin[:, 2]),
+                text(margin[:, 3]),
+                text(margin_per_lot[:, 0]),
+                text(margin_per_lot[:, 1]),
+                text(price_tick[valid]),
+                # 与内置round保持一致的舍入结果
+                [str(round(value, 2)) for value in (price_tick * multiple)[valid].tolist()],
+            ]
+        )
+        valid_lines = [header]
+        valid_lines.extend(",".join(row) + "\n" for row in zip(*columns))
+        invalid_lines = [header]
+        invalid_lines.extend(
+            ",".join(row) + "\n" for row in zip(*([column[i] for i in invalid_index] for column in base))
+        )
 
         print("\t有效合约交易费:", len(valid_lines) - 1)
         print("\t无效合约交易费:", len(invalid_lines) - 1)
@@ -405,11 +831,12 @@ class Export(object):
         invalid_name = f"openctp期货交易费用参照表（交易所+1分）-{self._spi.trading_day}-无效.csv"
 
         with open(valid_name, mode="w", encoding="utf8") as fp:
-            fp.writelines(valid_lines)
+            fp.write("".join(valid_lines))
         with open(invalid_name, mode="w", encoding="utf8") as fp:
-            fp.writelines(invalid_lines)
+            fp.write("".join(invalid_lines))
 
 
 if __name__ == "__main__":
     cli = Export()
-    cli.run()
+    if not cli.run():
+        exit(-1)
@@ -0,0 +1,149 @@
+"""
+ctpsettle成交记录解析耗时对比: 解析后遍历全部记录的update_enum_value与解析时内联枚举翻译
+
+usage: python benchmark.py [rows]
+"""
+
+import gc
+import itertools
+import os
+import sys
+import time
+
+from ctpsettle import TableStatus, TransactionsHandler, PositionsClosedHandler, PositionsDetailHandler, PositionsHandler
+
+SAMPLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample.out")
+TABLE_HANDLERS = (TransactionsHandler, PositionsClosedHandler, PositionsDetailHandler, PositionsHandler)
+
+TABLE_HEAD = (
+    "|成交日期| 投资单元 | 交易所 | 交易编码  |       品种       |      合约      |买/卖|   投/保    |  成交价  | 手数 |   成交额   |       开平       |  手续费  |  平仓盈亏  |     权利金收支      |     成交序号     |   资金账号   |",
+    "|  Date  |InvestUnit|Exchange|tradingcode|     Product      |   Instrument   | B/S |    S/H     |   Price  | Lots |  Turnover  |       O/C        |   Fee    |Realized P/L|Premium Received/Paid|     Trans.No.    |   AccountID  |",
+)
+SEPARATOR = "-" * 224
+ROWS = (
+    ("上期所", "白银", "ag2306", "   卖", "投机", "平今"),
+    ("上期所", "黄金", "au2308", "买   ", "投机", "开"),
+    ("大商所", "豆粕", "m2309", "   卖", "套保", "平昨"),
+    ("郑交所", "棉花", "CF309", "买   ", "套利", "平仓"),
+    ("中金所", "沪深300", "IF2306", "   卖", "投机", "强平"),
+    ("能源中心", "原油", "sc2307", "买   ", "做市商", "开"),
+)
+
+
+def pad(text: str, width: int) -> str:
+    """按GBK宽度左对齐, 与结算单中明细行和表头按字节对齐一致"""
+    return text + " " * (width - len(text.encode("gbk")))
+
+
+def makeTransactionTable(rows: int) -> list[str]:
+    """生成rows行成交明细的成交记录表格行"""
+    lines = [SEPARATOR, *TABLE_HEAD, SEPARATOR]
+    for i in range(rows):
+        exchange, product, instrument, direction, hedge, offset = ROWS[i % len(ROWS)]
+        lines.append(f"|20230215|123456    |{pad(exchange, 8)}|9999203177 |{pad(product, 18)}|{instrument:^16}|{direction}|{pad(hedge, 12)}|"
+                     f"{4900 + i % 100:>10.3f}|{1 + i % 10:>6}|{296760.0 + i:>12.2f}|{pad(offset, 18)}|{2.96:>10.2f}|{0:>12.2f}|"
+                     f"{0:>21.2f}|{i:<18}|123456        |")
+    lines.append(SEPARATOR)
+    lines.append(f"|共{rows:>6}条|          |        |           |                  |                      |            |          |"
+                 f"      |            |                  |          |            |                     |                  |              |")
+    lines.append(SEPARATOR)
+    return lines
+
+
+def makeStatement(rows: int, template: str = SAMPLE) -> str:
+    """以SimNow结算单sample.out为模板, 生成成交记录、平仓明细、持仓明细和持仓汇总各rows行的结算单
+
+    各表格的明细行循环使用模板中的明细行, 其它内容与模板相同
+    """
+    with open(template, encoding="utf-8", newline="") as f:
+        lines = f.read().split("\r\n")
+    titles = tuple(handler.TITLE for handler in TABLE_HANDLERS)
+    result = []
+    details = []
+    separators = None
+    for line in lines:
+        if any(title in line for title in titles):
+            separators = 0
+        elif separators is not None and line.startswith(TransactionsHandler.split_line):
+            separators += 1
+            if separators == 3:
+                result.extend(itertools.islice(itertools.cycle(details), rows))
+                details = []
+                separators = None
+        elif separators == 2:
+            # 表头之后第二条分隔线之前为明细行
+            details.append(line)
+            continue
+        result.append(line)
+    return "\r\n".join(result)
+
+
+class LegacyTransactionsHandler(TransactionsHandler):
+    """原实现: 逐行解析明细行, 全部解析完成后再按ENUM_VALUE_MAP x 结果键 x 记录遍历翻译枚举值"""
+
+    def parse(self, contents: list[str]) -> dict[str, any]:
+        self.result = {self.KEY: []}
+        currentStatusIdx = 0
+        currentStatus = self.status[currentStatusIdx]
+        for i in range(len(contents)):
+            if contents[i].startswith(self.split_line):
+                currentStatusIdx += 1
+                currentStatus = self.status[currentStatusIdx]
+                continue
+            elif currentStatus == TableStatus.DETAILS:
+                self.result[self.KEY].append(self.parse_detail(contents[i]))
+        self.update_enum_value()
+        return self.result
+
+    def update_enum_value(self):
+        for key, enumMap in self.ENUM_VALUE_MAP.items():
+            for resultKey in self.result.keys():
+                for record in self.result[resultKey]:
+                    if key in record:
+                        textValue = record[key]
+                        record[key] = enumMap.get(textValue)
+
+    def parse_detail(self, line: str) -> dict[str, any]:
+        compactLine = line.replace(" ", "")[1:-1]
+        cells = compactLine.split("|")
+        return {
+            "TradeDate": cells[0],
+            "InvestUnitID": cells[1],
+            "ExchangeID": cells[2],
+            "ClientID": cells[3],
+            "InstrumentID": cells[5],
+            "Direction": cells[6],
+            "HedgeFlag": cells[7],
+            "Price": float(cells[8]),
+            "Volume": int(cells[9]),
+            "Turnover": float(cells[10]),
+            "OffsetFlag": cells[11],
+            "TradeID": cells[15],
+            "AccountID": cells[16],
+        }
+
+
+def measure(handler_class, lines: list[str], repeat: int = 3):
+    """取repeat次中的最短耗时, 关闭gc避免大量记录对象触发的回收干扰计时"""
+    best = None
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = handler_class().parse(lines)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            del result
+    finally:
+        gc.enable()
+    return best, handler_class().parse(lines)
+
+
+if __name__ == '__main__':
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lines = makeTransactionTable(rows)
+    before, expected = measure(LegacyTransactionsHandler, lines)
+    after, result = measure(TransactionsHandler, lines)
+    assert result == expected and len(result[TransactionsHandler.KEY]) == rows
+    print(f"{'rows':>10}{'legacy(s)':>12}{'inline(s)':>12}{'speedup':>10}")
+    print(f"{rows:>10}{before:>12.3f}{after:>12.3f}{before / after:>10.2f}x")
@@ -2,12 +2,18 @@
 written by DennisXie on 2023-2-18
 """
 import argparse
+import codecs
 import datetime
+import gzip
+import itertools
 import os
 import re
 import json
+import operator
 import time
 import queue
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from openctp_ctp import tdapi as api
 
 verbose = False
@@ -17,6 +23,32 @@ def _print(*args, **kwargs):
         print(*args, **kwargs)
 
 
+def _rawContent(content) -> bytes:
+    """the GBK bytes of a chunk
+
+    openctp-ctp converts Content from GBK and decodes it with surrogateescape, so the byte of a character split at
+    the end of a chunk is kept as a surrogate and encoded back here. If a binding replaced that byte instead,
+    the split character cannot be recovered and is decoded as U+FFFD.
+    """
+    if isinstance(content, bytes):
+        return content
+    try:
+        return content.encode("gbk", errors="surrogateescape")
+    except UnicodeEncodeError:
+        return content.encode("gbk", errors="replace")
+
+
+def decodeSettlementChunks(chunks):
+    """decode (content, isLast) chunks incrementally, a GBK character split across two chunks is rejoined"""
+    decoder = codecs.getincrementaldecoder("gbk")(errors="replace")
+    for content, last in chunks:
+        text = decoder.decode(_rawContent(content), final=last)
+        if text:
+            yield text
+        if last:
+            return
+
+
 class UserConfig(object):
     brokerId: str = ""
     userId: str = ""
@@ -109,19 +141,36 @@ class CTdClient(api.CThostFtdcTraderSpi):
             exit(1)
 
     def querySettlementInfo(self, tradingDay: str) -> str:
+        return "".join(self.iterSettlementInfo(tradingDay))
+
+    def iterSettlementInfo(self, tradingDay: str):
+        """yield the settlement text chunk by chunk while the query is running"""
         _print(f"query settlement {self.userConfig}")
         req = api.CThostFtdcQrySettlementInfoField()
         req.BrokerID = self.userConfig.brokerId
         req.TradingDay = tradingDay
         req.InvestorID = self.userConfig.userId
-        self.tdapi.ReqQrySettlementInfo(req, self.reqId)
+        reqId = self.reqId
+        ret = self.tdapi.ReqQrySettlementInfo(req, reqId)
+        if ret != 0:
+            raise RuntimeError(f"query settlement failed, ret={ret}")
+
+        # CTP may split a multi-byte GBK character across two chunks
+        yield from decodeSettlementChunks(self.__receive(reqId))
 
-        content: str = ""
+    def __receive(self, reqId: int):
         last = False
         while not last:
-            chunk, last = self.__queue.get()
-            content = content + chunk
-        return content
+            requestId, content, isLast = self.__queue.get()
+            if requestId != reqId:
+                continue
+            last = isLast
+            yield content, last
+
+    def iterSettlementRecords(self, tradingDay: str, parser: "SettlementParser" = None):
+        """yield parsed (key, record) tuples while the settlement chunks arrive"""
+        parser = parser or SettlementParser()
+        return parser.iterparse(self.iterSettlementInfo(tradingDay))
 
     def OnRspQrySettlementInfo(self, pSettlementInfo: api.CThostFtdcSettlementInfoField,
                                pRspInfo: api.CThostFtdcRspInfoField, nRequestID: int, bIsLast: bool):
@@ -130,15 +179,29 @@ class CTdClient(api.CThostFtdcTraderSpi):
 
         if pSettlementInfo is not None:
             _print(f"content: {pSettlementInfo.Content}")
-            self.__queue.put_nowait((str(pSettlementInfo.Content), bIsLast))
+            self.__queue.put_nowait((nRequestID, pSettlementInfo.Content, bIsLast))
         else:
             _print(f"empty settlement content, last={bIsLast}")
+            if bIsLast:
+                self.__queue.put_nowait((nRequestID, b"", bIsLast))
 
 
 class SectionHandler(object):
 
     TITLE = ""
 
+    def begin(self):
+        """called when the title line of the section is found"""
+        pass
+
+    def feed(self, line: str):
+        """parse one line of the section, return a (key, record) tuple or None"""
+        return None
+
+    def end(self) -> dict[str, any]:
+        """called when the section ends, return the values not emitted by feed"""
+        return {}
+
     def parse(self, contents: list[str]):
         pass
 
@@ -158,21 +221,32 @@ class SettlementStatementHandler(SectionHandler):
         self.date_pattern: re.Pattern = re.compile(r"Date：\s*(?P<Date>\d+)")
         # match 1-n character, white spaces, /：0-n whitespace 1-n digital.1-n digital
         self.detail_pattern: re.Pattern = re.compile(r"[a-zA-Z\s/]+：\s*\d+\.\d+")
+        self.begin()
+
+    def begin(self):
         self.result = {
             self.CLIENT_ID_KEY: None,
             self.DATE_KEY: None,
             self.DETAILS_KEY: {}
         }
-    
+
+    def feed(self, line: str):
+        if not self.result[self.CLIENT_ID_KEY]:
+            self.parse_client_id(line)
+        elif not self.result[self.DATE_KEY]:
+            self.parse_date(line)
+        else:
+            self.parse_details(line)
+        return None
+
+    def end(self) -> dict[str, any]:
+        return self.result
+
     def parse(self, contents: list[str]):
+        self.begin()
         for line in contents:
-            if not self.result[self.CLIENT_ID_KEY]:
-                self.parse_client_id(line)
-            elif not self.result[self.DATE_KEY]:
-                self.parse_date(line)
-            else:
-                self.parse_details(line)
-        return self.result
+            self.feed(line)
+        return self.end()
 
     def parse_client_id(self, line: str):
         match = self.client_id_pattern.search(line)
@@ -194,6 +268,105 @@ class SettlementStatementHandler(SectionHandler):
                 self.result[self.DETAILS_KEY][kv[0]] = float(kv[1])
 
 
+class EnumCells(dict):
+    """translate the padded text or GBK bytes cells of an enum column, each distinct cell is looked up once"""
+
+    def __init__(self, enumMap: dict[str, str]):
+        super().__init__()
+        self.enumMap = enumMap
+
+    def __missing__(self, cell):
+        text = cell.strip()
+        if isinstance(text, bytes):
+            text = text.decode("gbk", errors="replace")
+        value = self[cell] = self.enumMap.get(text)
+        return value
+
+
+class ColumnarTable(object):
+    """Typed column buffers of one table section.
+
+    Number columns are array.array buffers and text columns are lists, so the rows
+    are appended without building a dict per row. to_numpy()/to_arrow() convert
+    the buffers to a structured array or an Arrow table, numpy and pyarrow are
+    only imported when they are used.
+    """
+
+    TYPECODES = {float: "d", int: "q"}
+
+    def __init__(self, columns: tuple[tuple[str, type], ...]):
+        self.types = dict(columns)
+        self.columns = {name: array(self.TYPECODES[kind]) if kind in self.TYPECODES else [] for name, kind in columns}
+
+    def __len__(self) -> int:
+        return max((len(values) for values in self.columns.values()), default=0)
+
+    def fill(self, name: str, value: str):
+        """add or extend a text column with one value, e.g. the date of the statement"""
+        if name not in self.columns:
+            self.types = {name: str, **self.types}
+            self.columns = {name: [], **self.columns}
+        values = self.columns[name]
+        values.extend([value] * (len(self) - len(values)))
+
+    def extend(self, other: "ColumnarTable"):
+        """append the rows of another table with the same columns"""
+        for name, values in other.columns.items():
+            self.columns[name].extend(values)
+
+    def to_numpy(self):
+        import numpy as np
+        dtypes = []
+        for name, kind in self.types.items():
+            if kind in self.TYPECODES:
+                dtypes.append((name, self.TYPECODES[kind]))
+            else:
+                width = max((len(value) for value in self.columns[name] if value is not None), default=1)
+                dtypes.append((name, f"U{max(width, 1)}"))
+        result = np.empty(len(self), dtype=dtypes)
+        for name, kind in self.types.items():
+            values = self.columns[name]
+            if kind in self.TYPECODES:
+                result[name] = np.frombuffer(values, dtype=self.TYPECODES[kind]) if values else []
+            else:
+                result[name] = ["" if value is None else value for value in values]
+        return result
+
+    def to_arrow(self):
+        import numpy as np
+        import pyarrow as pa
+        arrays = []
+        for name, kind in self.types.items():
+            values = self.columns[name]
+            if kind in self.TYPECODES:
+                arrays.append(pa.array(np.frombuffer(values, dtype=self.TYPECODES[kind]) if values else [],
+                                       type=pa.float64() if kind is float else pa.int64()))
+            else:
+                arrays.append(pa.array(values, type=pa.string()))
+        return pa.Table.from_arrays(arrays, names=list(self.types))
+
+
+def mergeColumnarTables(statements: dict[str, dict[str, ColumnarTable]]) -> dict[str, ColumnarTable]:
+    """concat the tables of several statements, the Statement column holds the key of each statement"""
+    merged = {}
+    for statement, tables in statements.items():
+        for key, table in tables.items():
+            table.fill("Statement", statement)
+            if key in merged:
+                merged[key].extend(table)
+            else:
+                merged[key] = table
+    return merged
+
+
+def writeParquet(tables: dict[str, ColumnarTable], directory: str):
+    """write each table to <directory>/<key>.parquet"""
+    import pyarrow.parquet as pq
+    os.makedirs(directory, exist_ok=True)
+    for key, table in tables.items():
+        pq.write_table(table.to_arrow(), os.path.join(directory, f"{key}.parquet"))
+
+
 class TableStatus(object):
     NONE = "None"
     HEADER = "header"
@@ -208,9 +381,7 @@ class TableHandler(SectionHandler):
     KEY = "Table"
 
     split_line = "------------------"
-    status = [TableStatus.NONE, TableStatus.HEADER, TableStatus.DETAILS, TableStatus.TOTAL, TableStatus.COMMENT]
-    handlers = {}
-    result = {}
+    status = (TableStatus.NONE, TableStatus.HEADER, TableStatus.DETAILS, TableStatus.TOTAL, TableStatus.COMMENT)
 
     HEADER_KEY = "Headers"
     DETAILS_KEY = "Details"
@@ -261,35 +432,141 @@ class TableHandler(SectionHandler):
         "ExchangeID": EXCHANGE_ID_MAP,
     }
 
+    # (key, english header label, default cell index, converter) of the detail row fields
+    COLUMNS = ()
+
     def __init__(self) -> None:
         super().__init__()
-    
-    def parse(self, contents: list[str]) -> dict[str, any]:
-        currentStatusIdx = 0
-        currentStatus = self.status[currentStatusIdx]
-        for i in range(len(contents)):
-            if contents[i].startswith(self.split_line):
-                currentStatusIdx += 1
-                currentStatus = self.status[currentStatusIdx]
-                continue
-            elif currentStatus in self.handlers:
-                self.handlers[currentStatus](contents[i])
-        self.update_enum_value()
-        return self.result
+        self.handlers = {}
+        self.table: ColumnarTable = None
+        self.default_build_row = self.compile_columns({})
+        self.begin()
+
+    def column_types(self) -> tuple[tuple[str, type], ...]:
+        return tuple((key, convert) for key, _, _, convert in self.COLUMNS)
+
+    def enable_columns(self) -> ColumnarTable:
+        """append the detail rows to typed column buffers instead of returning a dict per row"""
+        self.table = ColumnarTable(self.column_types())
+        self.default_build_row = self.compile_columns({})
+        self.build_row = self.default_build_row
+        return self.table
+
+    def begin(self):
+        self.currentStatusIdx = 0
+        self.build_row = self.default_build_row
+
+    def feed(self, line: str):
+        if line.startswith(self.split_line):
+            self.currentStatusIdx = min(self.currentStatusIdx + 1, len(self.status) - 1)
+            return None
+        handler = self.handlers.get(self.status[self.currentStatusIdx])
+        if handler is None:
+            return None
+        record = handler(line)
+        if record is None:
+            return None
+        return self.KEY, record
 
-    def update_enum_value(self):
-        for key, enumMap in self.ENUM_VALUE_MAP.items():
-            for resultKey in self.result.keys():
-                for record in self.result[resultKey]:
-                    if key in record:
-                        textValue = record[key]
-                        record[key] = enumMap.get(textValue)
+    def parse(self, contents: list[str]) -> dict[str, any]:
+        self.begin()
+        records = []
+        for line in contents:
+            parsed = self.feed(line)
+            if parsed is not None:
+                records.append(parsed[1])
+        self.end()
+        return {self.KEY: records}
+
+    def compile_columns(self, indexes: dict[str, int]) -> callable:
+        """build the row function of COLUMNS over the cells of line.split("|")
+
+        indexes maps keys to the cell indexes found in the header, other columns keep their default index.
+        """
+        row = self.compile_row([(key, indexes.get(key, index) + 1, self.converter(key, convert))
+                                for key, _, index, convert in self.COLUMNS])
+        return lambda line: row(line.split("|"))
+
+    def compile_slices(self, offsets: dict[str, slice], width: int, split_row: callable) -> callable:
+        """build the row function of COLUMNS over the GBK bytes of the line, each cell is sliced at its header offsets
+
+        The detail rows are aligned to the header by GBK width. A row of another width or without the separators
+        around the used columns, e.g. with a wider O/C cell, is parsed by split_row instead.
+        """
+        row = self.compile_row([(key, offsets[key], self.gbk_converter(key, convert))
+                                for key, _, _, convert in self.COLUMNS])
+        positions = sorted({position for cell in offsets.values() for position in (cell.start - 1, cell.stop)})
+        separators = operator.itemgetter(*positions)
+        expected = separators(b"|" * width)
+        # the encoder function skips the codec lookup of str.encode("gbk") on every line
+        encode = codecs.getencoder("gbk")
+
+        def sliced_row(line):
+            raw = encode(line, "replace")[0]
+            if len(raw) == width and separators(raw) == expected:
+                return row(raw)
+            return split_row(line)
+        return sliced_row
+
+    def compile_row(self, spec: list[tuple[str, any, callable]]) -> callable:
+        """build the row function of (key, position, converter) over the cells indexed by position
+
+        The function returns a dict of the row, or appends the values to the column buffers after
+        enable_columns(). Only the used cells are converted, float() and int() accept the padding spaces,
+        enum fields are translated by the lookup of their map.
+        """
+        if self.table is None:
+            return lambda cells: {key: convert(cells[i]) for key, i, convert in spec}
+        appends = [(self.table.columns[key].append, i, convert) for key, i, convert in spec]
+
+        def append_row(cells):
+            for append, i, convert in appends:
+                append(convert(cells[i]))
+        return append_row
+
+    def converter(self, key: str, convert: type) -> callable:
+        """the converter of one cell: enum lookup, strip for text, float()/int() for numbers"""
+        if key in self.ENUM_VALUE_MAP:
+            return EnumCells(self.ENUM_VALUE_MAP[key]).__getitem__
+        if convert is str:
+            return str.strip
+        return convert
+
+    def gbk_converter(self, key: str, convert: type) -> callable:
+        """the converter of one GBK bytes cell, float() and int() accept bytes"""
+        if key in self.ENUM_VALUE_MAP:
+            return EnumCells(self.ENUM_VALUE_MAP[key]).__getitem__
+        if convert is str:
+            # the decoder function skips the codec lookup of bytes.decode("gbk") on every cell
+            decode = codecs.getdecoder("gbk")
+            return lambda cell: decode(cell.strip(), "replace")[0]
+        return convert
 
     def parse_header(self, line: str):
-        pass
+        """locate the columns by the english header labels, so added or moved columns are still parsed correctly
+
+        The (start, end) GBK byte offsets of the used columns are recorded, so the cells are sliced from the
+        detail rows directly instead of splitting every cell of the row.
+        """
+        cells = line.encode("gbk", errors="replace").split(b"|")[1:-1]
+        labels = [cell.strip().decode("ascii", errors="replace") for cell in cells]
+        indexes = {key: labels.index(header) for key, header, _, _ in self.COLUMNS if header in labels}
+        if not indexes:
+            return None
+        self.build_row = self.compile_columns(indexes)
+
+        starts = list(itertools.accumulate((len(cell) + 1 for cell in cells), initial=1))
+        offsets = {}
+        for key, _, index, _ in self.COLUMNS:
+            index = indexes.get(key, index)
+            if index >= len(cells):
+                return None
+            offsets[key] = slice(starts[index], starts[index] + len(cells[index]))
+        self.build_row = self.compile_slices(offsets, starts[-1], self.build_row)
+        return None
 
     def parse_detail(self, line: str) -> dict[str, any]:
-        pass
+        return self.build_row(line)
 
     def parse_total(self, line: str) -> dict[str, any]:
         pass
@@ -303,116 +580,104 @@ class TransactionsHandler(TableHandler):
     TITLE = "成交记录"
     KEY = "Transactions"
 
+    COLUMNS = (
+        ("TradeDate", "Date", 0, str),
+        ("InvestUnitID", "InvestUnit", 1, str),
+        ("ExchangeID", "Exchange", 2, str),
+        ("ClientID", "tradingcode", 3, str),                    # TradingCode=ClientId
+        # ("ProductID", "Product", 4, str),
+        ("InstrumentID", "Instrument", 5, str),
+        ("Direction", "B/S", 6, str),
+        ("HedgeFlag", "S/H", 7, str),
+        ("Price", "Price", 8, float),
+        ("Volume", "Lots", 9, int),
+        ("Turnover", "Turnover", 10, float),
+        ("OffsetFlag", "O/C", 11, str),
+        # ("Fee", "Fee", 12, float),                            # not used
+        # ("RealizedP/L", "Realized P/L", 13, float),           # not used
+        # ("PremiumReceived/Paid", "Premium Received/Paid", 14, float), # not used
+        ("TradeID", "Trans.No.", 15, str),                      # Trans.No. = TradeID
+        ("AccountID", "AccountID", 16, str),
+    )
+
     def __init__(self) -> None:
         super().__init__()
         self.handlers = {
+            TableStatus.HEADER: self.parse_header,
             TableStatus.DETAILS: self.parse_detail,
         }
-        self.result = {
-            self.KEY: []
-        }
     
-    def parse_detail(self, line: str) -> dict[str, any]:
-        compactLine = line.replace(" ", "")[1:-1]
-        cells = compactLine.split("|")
-        self.result[self.KEY].append({
-            "TradeDate": cells[0],
-            "InvestUnitID": cells[1],
-            "ExchangeID": cells[2],
-            "ClientID": cells[3],                       # TradingCode=ClientId
-            # "ProductID": cells[4],
-            "InstrumentID": cells[5],
-            "Direction": cells[6],
-            "HedgeFlag": cells[7],
-            "Price": float(cells[8]),
-            "Volume": int(cells[9]),
-            "Turnover": float(cells[10]),
-            "OffsetFlag": cells[11],
-            # "Fee": float(cells[12]),                    # not used
-            # "RealizedP/L": float(cells[13]),            # not used
-            # "PremiumReceived/Paid": float(cells[14]),   # not used
-            "TradeID": cells[15],                         # Trans.No. = TradeID
-            "AccountID": cells[16]                      
-        })
-
-
 class PositionsClosedHandler(TableHandler):
 
     TITLE = "平仓明细"
     KEY = "PositionsClosed"
 
+    COLUMNS = (
+        # ("CloseDate", "Close Date", 0, str),
+        ("InvestUnitID", "InvestUnit", 1, str),
+        ("ExchangeID", "Exchange", 2, str),
+        ("ClientID", "tradingcode", 3, str),                    # not sure TradingCode=TradeID
+        # ("ProductID", "Product", 4, str),
+        ("InstrumentID", "Instrument", 5, str),
+        ("OpenDate", "Open Date", 6, str),
+        ("HedgeFlag", "S/H", 7, str),
+        ("Direction", "B/S", 8, str),
+        ("Volume", "Lots", 9, int),
+        ("OpenPrice", "Pos. Open Price", 10, float),
+        ("LastSettlementPrice", "Prev. Sttl", 11, float),
+        ("Price", "Trans. Price", 12, float),
+        # ("RealizedP/L", "Realized P/L", 13, float),           # not found
+        # ("PremiumReceived/Paid", "Premium Received/Paid", 14, float), # not found
+        ("AccountID", "AccountID", 15, str),
+    )
+
     def __init__(self) -> None:
         super().__init__()
         self.handlers = {
+            TableStatus.HEADER: self.parse_header,
             TableStatus.DETAILS: self.parse_detail,
         }
-        self.result = {
-            self.KEY: []
-        }
     
+    def feed(self, line: str):
+        """PostionsClosed information not needed"""
+        return None
+
     def parse(self, contents: list[str]) -> dict[str, any]:
         """PostionsClosed information not needed"""
         return {}
     
-    def parse_detail(self, line: str) -> dict[str, any]:
-        compactLine = line.replace(" ", "")[1:-1]
-        cells = compactLine.split("|")
-        self.result[self.KEY].append({
-            # "CloseDate": cells[0],             
-            "InvestUnitID": cells[1],
-            "ExchangeID": cells[2],
-            "ClientID": cells[3],                # not sure TradingCode=TradeID
-            # "ProductID": cells[4],
-            "InstrumentID": cells[5],
-            "OpenDate": cells[6],
-            "HedgeFlag": cells[7],
-            "Direction": cells[8],
-            "Volume": int(cells[9]),
-            "OpenPrice": float(cells[10]),
-            "LastSettlementPrice": float(cells[11]),
-            "Price": float(cells[12]),
-            # "RealizedP/L": float(cells[13]),    # not found
-            # "PremiumReceived/Paid": float(cells[14]),   # not found
-            "AccountID": cells[15]
-        })
-
 class PositionsDetailHandler(TableHandler):
 
     TITLE = "持仓明细"
     KEY = "PositionsDetail"
 
+    COLUMNS = (
+        ("InvestUnitID", "InvestUnit", 0, str),
+        ("ExchangeID", "Exchange", 1, str),
+        # ("ClientID", "tradingcode", 2, str),                  # not used in position details
+        # ("ProductID", "Product", 3, str),
+        ("InstrumentID", "Instrument", 4, str),
+        ("OpenDate", "Open Date", 5, str),
+        ("HedgeFlag", "S/H", 6, str),
+        ("Direction", "B/S", 7, str),
+        ("Volume", "Positon", 8, int),
+        ("OpenPrice", "Pos. Open Price", 9, float),
+        ("LastSettlementPrice", "Prev. Sttl", 10, float),
+        ("SettlementPrice", "Settlement Price", 11, float),
+        # ("AccumP/L", "Accum. P/L", 12, float),                # not used
+        # ("MTMP/L", "MTM P/L", 13, float),                     # not used
+        ("Margin", "Margin", 14, float),
+        # ("MarketValueOptions", "Market Value(Options)", 15, float), # no used
+        ("AccountID", "AccountID", 16, str),
+    )
+
     def __init__(self) -> None:
         super().__init__()
         self.handlers = {
+            TableStatus.HEADER: self.parse_header,
             TableStatus.DETAILS: self.parse_detail,
         }
-        self.result = {
-            self.KEY: []
-        }
     
-    def parse_detail(self, line: str) -> dict[str, any]:
-        compactLine = line.replace(" ", "")[1:-1]
-        cells = compactLine.split("|")
-        self.result[self.KEY].append({
-            "InvestUnitID": cells[0],
-            "ExchangeID": cells[1],
-            # "ClientID": cells[2],            # not used in position details
-            # "ProductID": cells[3],
-            "InstrumentID": cells[4],
-            "OpenDate": cells[5],
-            "HedgeFlag": cells[6],
-            "Direction": cells[7],
-            "Volume": int(cells[8]),
-            "OpenPrice": float(cells[9]),
-            "LastSettlementPrice": float(cells[10]),
-            "SettlementPrice": float(cells[11]),
-            # "AccumP/L": float(cells[12]),   # not used
-            # "MTMP/L": float(cells[13]),     # not used
-            "Margin": float(cells[14]),
-            # "MarketValueOptions": float(cells[15]),   # no used
-            "AccountID": cells[16]
-        })
-
 class PositionsHandler(TableHandler):
 
     TITLE = "持仓汇总"
@@ -422,97 +687,307 @@ class PositionsHandler(TableHandler):
     POSITION_LONG = "2"
     POSITION_SHORT = "3"
 
+    COLUMNS = (
+        ("InvestUnitID", "InvestUnit", 0, str),
+        # ("ClientID", "tradingcode", 1, str),                  # not used in position
+        # ("ProductID", "Product", 2, str),
+        ("InstrumentID", "Instrument", 3, str),
+        ("LongFrozen", "Long Pos.", 4, int),
+        ("AvgBuyPrice", "Avg Buy Price", 5, float),
+        ("ShortFrozen", "Short Pos.", 6, int),
+        ("AvgSellPrice", "Avg Sell Price", 7, float),
+        ("PreSettlementPrice", "Prev. Sttl", 8, float),
+        ("SettlementPrice", "Sttl Today", 9, float),
+        # ("MTMP/L", "MTM P/L", 10, float),                     # not found
+        ("UseMargin", "Margin Occupied", 11, float),
+        ("HedgeFlag", "S/H", 12, str),
+        # ("MarketValue(Long)", "Market Value(Long)", 13, float), # not found
+        # ("MarketValue(Short)", "Market Value(Short)", 14, float), # not found
+        ("AccountID", "AccountID", 15, str),
+    )
+
     def __init__(self) -> None:
         super().__init__()
         self.handlers = {
+            TableStatus.HEADER: self.parse_header,
             TableStatus.DETAILS: self.parse_detail,
         }
-        self.result = {
-            self.KEY: []
-        }
     
-    def parse_detail(self, line: str) -> dict[str, any]:
-        compactLine = line.replace(" ", "")[1:-1]
-        cells = compactLine.split("|")
-        detail = {
-            "InvestUnitID": cells[0],
-            # "ClientID": cells[1],        # not used in position
-            # "ProductID": cells[2],
-            "InstrumentID": cells[3],
-            "LongFrozen": int(cells[4]),
-            "AvgBuyPrice": float(cells[5]),
-            "ShortFrozen": int(cells[6]),
-            "AvgSellPrice": float(cells[7]),
-            "PreSettlementPrice": float(cells[8]),
-            "SettlementPrice": float(cells[9]),
-            # "MTMP/L": float(cells[10]),         # not found
-            "UseMargin": float(cells[11]),
-            "HedgeFlag": cells[12],
-            # "MarketValue(Long)": float(cells[13]),      # not found
-            # "MarketValue(Short)": float(cells[14]),     # not found
-            "AccountID": cells[15],
-        }
-        net_position = detail['LongFrozen'] - detail['ShortFrozen']
-        position_direction = self.POSITION_NET
+    def column_types(self) -> tuple[tuple[str, type], ...]:
+        return super().column_types() + (("PosiDirection", str), ("Position", int))
+
+    def position(self, long_position: int, short_position: int) -> tuple[str, int]:
+        net_position = long_position - short_position
         if net_position > 0:
             position_direction = self.POSITION_LONG
         elif net_position < 0:
             position_direction = self.POSITION_SHORT
         else:
             position_direction = self.POSITION_NET
-        detail["PosiDirection"] = position_direction
-        detail["Position"] = abs(net_position)
-        self.result[self.KEY].append(detail)
+        return position_direction, abs(net_position)
+
+    def parse_detail(self, line: str) -> dict[str, any]:
+        detail = super().parse_detail(line)
+        if detail is None:
+            return None
+        detail["PosiDirection"], detail["Position"] = self.position(detail['LongFrozen'], detail['ShortFrozen'])
         # TODO: add PositionCost
+        return detail
+
+    def end(self) -> dict[str, any]:
+        if self.table is not None:
+            columns = self.table.columns
+            done = len(columns["Position"])
+            for long_position, short_position in zip(columns["LongFrozen"][done:], columns["ShortFrozen"][done:]):
+                position_direction, position = self.position(long_position, short_position)
+                columns["PosiDirection"].append(position_direction)
+                columns["Position"].append(position)
+        return super().end()
+
+
+class SettlementParseSession(object):
+    """The state of parsing one statement, with its own handler instances.
+
+    Chunks are fed as they arrive, complete lines are dispatched to the handler of
+    the current section and parsed records are yielded as (key, value) tuples:
+    one tuple per table row, and the statement header values when its section ends.
+    Only the unfinished last line is buffered.
+    """
+
+    def __init__(self, line_spliter: str, handlers: dict[str, SectionHandler]):
+        self._line_spliter = line_spliter
+        self._handlers = handlers
+        self._buffer: str = ""
+        self._current: SectionHandler = None
+        self._remaining: list[str] = list(self._handlers.keys())
+        self._title_pattern: re.Pattern = self._compile_titles()
+        self.sections: list[str] = []
+
+    def _compile_titles(self) -> re.Pattern:
+        if not self._remaining:
+            return None
+        return re.compile("|".join(re.escape(title) for title in self._remaining))
+
+    def feed(self, chunk: str):
+        """feed a chunk of the statement, yield the records of its complete lines"""
+        lines = (self._buffer + chunk).split(self._line_spliter)
+        self._buffer = lines.pop()
+        for line in lines:
+            yield from self._feed_line(line)
+
+    def close(self):
+        """flush the last line and the current section"""
+        yield from self._feed_line(self._buffer)
+        self._buffer = ""
+        yield from self._end_section()
+
+    def _feed_line(self, line: str):
+        if self._title_pattern is not None:
+            match = self._title_pattern.search(line)
+            if match:
+                yield from self._end_section()
+                title = match.group()
+                self._remaining.remove(title)
+                self._title_pattern = self._compile_titles()
+                self.sections.append(title)
+                self._current = self._handlers[title]
+                self._current.begin()
+        if self._current is not None:
+            record = self._current.feed(line)
+            if record is not None:
+                yield record
+
+    def _end_section(self):
+        if self._current is not None:
+            yield from self._current.end().items()
+            self._current = None
 
 
 class SettlementParser(object):
+    """Single pass settlement parser.
+
+    Every parse()/iterparse() call runs in its own SettlementParseSession, so one
+    parser can be reused and shared between threads. feed()/close() keep one
+    session on the parser for chunks that arrive over time.
+    """
 
     HEADER = 0
     MTM = 1
     POSITIONS_DETAILS = 2
     POSITIONS = 3
 
+    HANDLERS = (
+        SettlementStatementHandler,
+        TransactionsHandler,
+        PositionsClosedHandler,
+        PositionsDetailHandler,
+        PositionsHandler,
+    )
+
     def __init__(self, line_spliter="\r\n"):
         self._line_spliter = line_spliter
-        self._handlers: dict[str, SectionHandler] = {
-            SettlementStatementHandler.TITLE: SettlementStatementHandler(),
-            TransactionsHandler.TITLE: TransactionsHandler(),
-            PositionsClosedHandler.TITLE: PositionsClosedHandler(),
-            PositionsDetailHandler.TITLE: PositionsDetailHandler(),
-            PositionsHandler.TITLE: PositionsHandler()
-        }
+        self._session: SettlementParseSession = None
+
+    def session(self) -> SettlementParseSession:
+        return SettlementParseSession(self._line_spliter, {handler.TITLE: handler() for handler in self.HANDLERS})
+
+    def feed(self, chunk: str):
+        """feed a chunk of the statement, yield the records of its complete lines"""
+        if self._session is None:
+            self._session = self.session()
+        yield from self._session.feed(chunk)
+
+    def close(self):
+        """flush the last line and the current section, the next feed starts a new statement"""
+        if self._session is not None:
+            yield from self._session.close()
+        self._session = None
+
+    def iterparse(self, chunks):
+        session = self.session()
+        for chunk in chunks:
+            yield from session.feed(chunk)
+        yield from session.close()
+
+    def parse_columns(self, content: str) -> dict[str, ColumnarTable]:
+        """parse the Transactions, PositionsDetail and Positions tables into typed column buffers"""
+        session = self.session()
+        tables = {}
+        for handler in session._handlers.values():
+            if isinstance(handler, TableHandler) and not isinstance(handler, PositionsClosedHandler):
+                tables[handler.KEY] = handler.enable_columns()
+        for _ in itertools.chain(session.feed(content), session.close()):
+            pass
+        return tables
 
     def parse(self, content: str):
-        contentLines = content.split(self._line_spliter)
-        sections = self._split_to_section(contentLines)
         parsed = dict()
-        for title, section in sections.items():
-            start, end = section
-            if title in self._handlers:
-                result = self._handlers[title].parse(contentLines[start:end])
-                parsed.update(result)
+        session = self.session()
+        tables = {handler.KEY for handler in self.HANDLERS if issubclass(handler, TableHandler)}
+        for key, value in itertools.chain(session.feed(content), session.close()):
+            if key in tables:
+                parsed.setdefault(key, []).append(value)
+            else:
+                parsed[key] = value
+        # keep the empty tables of the sections found
+        for title in session.sections:
+            handler = session._handlers[title]
+            if isinstance(handler, TableHandler) and not isinstance(handler, PositionsClosedHandler):
+                parsed.setdefault(handler.KEY, [])
         return parsed
 
-    def _split_to_section(self, contentLines: list[str]) -> dict[str, (int, int)]:
-        section_start = 0
-        current_section = None
-        sections: dict[str, (int, int)] = {}
-        checked = {
-            current_section: 1
-        }
-        for i in range(len(contentLines)):
-            for title in self._handlers.keys():
-                if title not in checked and contentLines[i].find(title) >= 0:
-                    sections[current_section] = (section_start, i)
-                    checked[title] = 1
-                    current_section = title
-                    section_start = i
-                    break
-        else:
-            if section_start < len(contentLines) and current_section not in sections:
-                sections[current_section] = (section_start, len(contentLines))
-        return sections
+
+def readSettlementFile(path: str) -> str:
+    """read a raw statement saved by --raw or --archive, plain text or gzip"""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        return f.read()
+
+
+def parseSettlementFile(path: str) -> dict[str, any]:
+    content = readSettlementFile(path)
+    return SettlementParser("\r\n" if "\r\n" in content else "\n").parse(content)
+
+
+def parseSettlementFileColumns(path: str) -> dict[str, ColumnarTable]:
+    content = readSettlementFile(path)
+    return SettlementParser("\r\n" if "\r\n" in content else "\n").parse_columns(content)
+
+
+def parseSettlementFiles(paths: list[str], jobs: int = None, columnar: bool = False) -> dict[str, dict]:
+    """parse raw statements with a process pool, return the results keyed by path"""
+    parse = parseSettlementFileColumns if columnar else parseSettlementFile
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunksize = max(1, len(paths) // ((jobs or os.cpu_count() or 1) * 4))
+        return dict(zip(paths, executor.map(parse, paths, chunksize=chunksize)))
+
+
+class SettlementArchive(object):
+    """raw settlement statements stored as <directory>/<brokerId>/<userId>/<date>.txt.gz"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def path(self, brokerId: str, userId: str, date: str) -> str:
+        return os.path.join(self.directory, brokerId, userId, f"{date}.txt.gz")
+
+    def load(self, brokerId: str, userId: str, date: str) -> str:
+        path = self.path(brokerId, userId, date)
+        if not os.path.exists(path):
+            return None
+        with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def save(self, brokerId: str, userId: str, date: str, content: str):
+        path = self.path(brokerId, userId, date)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8", newline="") as f:
+            f.write(content)
+        os.replace(tmp, path)
+
+
+def settlementDates(start: str, end: str) -> list[str]:
+    """weekdays between start and end, both included"""
+    day = datetime.datetime.strptime(start, "%Y%m%d")
+    last = datetime.datetime.strptime(end, "%Y%m%d")
+    dates = []
+    while day <= last:
+        if day.weekday() < 5:
+            dates.append(day.strftime("%Y%m%d"))
+        day += datetime.timedelta(days=1)
+    return dates
+
+
+class SettlementDownloader(object):
+    """Download the statements of many dates over one logged in CTdClient.
+
+    Statements found in the archive are not queried again. The counter answers one
+    query at a time, so the next date is requested as soon as the previous one is
+    complete, at most `rate` requests per second, retrying on flow control.
+    """
+
+    RETRY = 5
+
+    def __init__(self, user: UserConfig, front: str, archive: SettlementArchive = None, rate: float = 1.0):
+        self.user = user
+        self.front = front
+        self.archive = archive
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._client: CTdClient = None
+        self._lastQuery = 0.0
+
+    @property
+    def client(self) -> CTdClient:
+        # login only when a statement is missing from the archive
+        if self._client is None:
+            self._client = CTdClient(self.user, self.front)
+            self._client.connect()
+        return self._client
+
+    def download(self, dates: list[str]):
+        """yield (date, content) for each date, content is empty if there is no statement"""
+        for date in dates:
+            content = None
+            if self.archive is not None:
+                content = self.archive.load(self.user.brokerId, self.user.userId, date)
+            if content is None:
+                content = self._query(date)
+                if content and self.archive is not None:
+                    self.archive.save(self.user.brokerId, self.user.userId, date, content)
+            yield date, content
+
+    def _query(self, date: str) -> str:
+        for retry in range(self.RETRY):
+            wait = self._lastQuery + self.interval * (2 ** retry) - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._lastQuery = time.monotonic()
+            try:
+                return self.client.querySettlementInfo(date)
+            except RuntimeError as e:
+                _print(f"{e}, retry {retry + 1}")
+        raise RuntimeError(f"query settlement of {date} failed")
 
 
 if __name__ == "__main__":
@@ -527,11 +1002,32 @@ if __name__ == "__main__":
     parser.add_argument("--appid", dest="appId", required=False, help="App ID, default simnow_client_test, can also be specified by CTP_APP_ID")
     parser.add_argument("--authcode", dest="authCode", required=False, help="Auth Code, default 0000000000000000, can also be specified by  CTP_AUTH_CODE")
     parser.add_argument("-d", "--date", dest="date", required=False, help="Date, yyyymmdd, default yesterday")
+    parser.add_argument("--from", dest="dateFrom", required=False, help="First date of a date range, yyyymmdd. Output is a json object keyed by date")
+    parser.add_argument("--to", dest="dateTo", required=False, help="Last date of a date range, yyyymmdd, default the same as --from")
+    parser.add_argument("--archive", dest="archive", required=False, help="Archive directory of raw statements, archived dates are not queried again")
+    parser.add_argument("--rate", dest="rate", type=float, default=1.0, required=False, help="Max settlement queries per second, default 1")
+    parser.add_argument("--parse", dest="parse", required=False, help="Parse the raw statements (*.txt, *.txt.gz) in a directory, e.g. an archive, instead of querying. Output is a json object keyed by relative path")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, required=False, help="Worker processes of --parse, default cpu count")
+    parser.add_argument("--format", dest="format", choices=("json", "parquet"), default="json", required=False, help="Output format, parquet writes the Transactions, PositionsDetail and Positions tables to <output>/<table>.parquet")
+    parser.add_argument("-o", "--output", dest="output", default=".", required=False, help="Output directory of --format parquet, default current directory")
     parser.add_argument("-v", "--verbose", dest="verbose", action="store_true", required=False, help="Print more detailed log")
     parser.add_argument("--raw", dest="raw", action="store_true", default=False, required=False, help="Print raw settlement info instead of json format")
 
     args = parser.parse_args()
     verbose = args.verbose
+    if args.parse:
+        paths = []
+        for root, _, files in os.walk(args.parse):
+            paths.extend(os.path.join(root, name) for name in files if name.endswith((".txt", ".txt.gz")))
+        paths.sort()
+        parsedFiles = parseSettlementFiles(paths, args.jobs, args.format == "parquet")
+        merged = {os.path.relpath(path, args.parse).replace(os.sep, "/").removesuffix(".gz").removesuffix(".txt"): parsed
+                  for path, parsed in parsedFiles.items()}
+        if args.format == "parquet":
+            writeParquet(mergeColumnarTables(merged), args.output)
+        else:
+            print(json.dumps(merged, indent=2, ensure_ascii=False))
+        exit(0)
     # brokerId, userId, password, appId, authCode
     brokerId = args.brokerId or os.getenv("CTP_BROKER", "9999")
     userId = args.userId or os.getenv("CTP_USER", None)
@@ -546,20 +1042,40 @@ if __name__ == "__main__":
         exit(1)
 
     user = UserConfig(brokerId, userId, password, appId, authCode)
-    client = CTdClient(user, front)
-    client.connect()
+    archive = SettlementArchive(args.archive) if args.archive else None
+    downloader = SettlementDownloader(user, front, archive, args.rate)
 
-    if not args.date:
-        today: datetime.datetime = datetime.datetime.now()
-        yesterday: datetime.datetime = today - datetime.timedelta(days=1)
-        args.date = yesterday.strftime("%Y%m%d")
-    settlementInfoText = client.querySettlementInfo(args.date)
-
-    if args.raw:
-        print(settlementInfoText)
+    if args.dateFrom:
+        dates = settlementDates(args.dateFrom, args.dateTo or args.dateFrom)
     else:
+        if not args.date:
+            today: datetime.datetime = datetime.datetime.now()
+            yesterday: datetime.datetime = today - datetime.timedelta(days=1)
+            args.date = yesterday.strftime("%Y%m%d")
+        dates = [args.date]
+
+    results = {}
+    for date, settlementInfoText in downloader.download(dates):
+        if args.raw:
+            if args.dateFrom:
+                print(f"==================== {date} ====================")
+            print(settlementInfoText)
+            continue
+        if args.dateFrom and not settlementInfoText:
+            _print(f"no settlement on {date}")
+            continue
         parser = SettlementParser()
+        if args.format == "parquet":
+            results[date] = parser.parse_columns(settlementInfoText)
+            continue
         parsed = parser.parse(settlementInfoText)
         # There is no BrokerID in settlement info, add the BrokerID to parsed result.
         parsed['BrokerID'] = brokerId
-        print(json.dumps(parsed, indent=2, ensure_ascii=False))
+        results[date] = parsed
+
+    if args.raw:
+        exit(0)
+    if args.format == "parquet":
+        writeParquet(mergeColumnarTables(results), args.output)
+    else:
+        print(json.dumps(results if args.dateFrom else results[dates[0]], indent=2, ensure_ascii=False))
@@ -0,0 +1,106 @@
+"""
+ctpsettle解析器的基准测试与回归测试
+
+usage: pytest test_ctpsettle_benchmark.py [--benchmark-only]
+
+以sample.out为模板生成各表格rows行的结算单, 用sample.json校验解析结果, 并记录解析吞吐量(lines/s, MB/s)和内存峰值。
+基准测试需要安装pytest-benchmark, 正确性测试不依赖该插件。
+"""
+
+import itertools
+import json
+import os
+import tracemalloc
+
+import pytest
+
+from benchmark import SAMPLE, makeStatement
+from ctpsettle import SettlementParser
+
+try:
+    import pytest_benchmark
+except ImportError:
+    pytest_benchmark = None
+
+GOLDEN = os.path.join(os.path.dirname(SAMPLE), "sample.json")
+SIZES = (1000, 10000, 100000)
+TABLES = ("Transactions", "PositionsDetail", "Positions")
+CHUNK_SIZE = 4096
+
+needs_benchmark = pytest.mark.skipif(pytest_benchmark is None, reason="pytest-benchmark is not installed")
+
+
+def loadGolden() -> dict:
+    with open(GOLDEN, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def expectedStatement(rows: int) -> dict:
+    """sample.json中各表格的记录循环扩展到rows行, 即makeStatement(rows)的解析结果"""
+    expected = loadGolden()
+    for key in TABLES:
+        expected[key] = list(itertools.islice(itertools.cycle(expected[key]), rows))
+    return expected
+
+
+@pytest.fixture(scope="module", params=SIZES, ids=lambda rows: f"{rows}rows")
+def statement(request):
+    return request.param, makeStatement(request.param)
+
+
+def test_sample_golden():
+    with open(SAMPLE, encoding="utf-8", newline="") as f:
+        assert SettlementParser().parse(f.read()) == loadGolden()
+
+
+def test_statement_golden(statement):
+    rows, content = statement
+    assert SettlementParser().parse(content) == expectedStatement(rows)
+
+
+def test_iterparse_golden(statement):
+    rows, content = statement
+    chunks = (content[i:i + CHUNK_SIZE] for i in range(0, len(content), CHUNK_SIZE))
+    parsed = {}
+    for key, value in SettlementParser().iterparse(chunks):
+        if key in TABLES:
+            parsed.setdefault(key, []).append(value)
+        else:
+            parsed[key] = value
+    assert parsed == expectedStatement(rows)
+
+
+def test_columns_golden(statement):
+    rows, content = statement
+    tables = SettlementParser().parse_columns(content)
+    expected = expectedStatement(rows)
+    for key in TABLES:
+        columns = tables[key].columns
+        assert [dict(zip(columns, values)) for values in zip(*columns.values())] == expected[key]
+
+
+def measure(benchmark, parse, content: str):
+    """记录一次解析的内存峰值, 再测量解析耗时并换算为吞吐量"""
+    tracemalloc.start()
+    parse(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    benchmark.extra_info["peak MB"] = peak / 1e6
+    benchmark.pedantic(parse, args=(content,), rounds=3, iterations=1, warmup_rounds=1)
+    if benchmark.stats is not None:
+        mean = benchmark.stats.stats.mean
+        benchmark.extra_info["lines/s"] = content.count("\r\n") / mean
+        # CTP柜台返回的结算单为GBK编码
+        benchmark.extra_info["MB/s"] = len(content.encode("gbk")) / mean / 1e6
+
+
+@needs_benchmark
+def test_parse_throughput(benchmark, statement):
+    _, content = statement
+    measure(benchmark, SettlementParser().parse, content)
+
+
+@needs_benchmark
+def test_parse_columns_throughput(benchmark, statement):
+    _, content = statement
+    measure(benchmark, SettlementParser().parse_columns, content)
@@ -1,6 +1,7 @@
 import json
 from ctpsettle import TransactionsHandler
 from ctpsettle import SettlementParser
+from ctpsettle import decodeSettlementChunks
 
 def testTransactionHandler():
     handler = TransactionsHandler()
@@ -117,5 +118,78 @@ def testSettlementParser():
     result = parser.parse(text)
     print(json.dumps(result, ensure_ascii=False, indent=2))
 
+def testIterParse():
+    with open("sample.out", encoding="utf-8", newline="") as f:
+        text = f.read()
+    expected = SettlementParser().parse(text)
+
+    # feed the statement in small chunks, records are emitted while parsing
+    parser = SettlementParser()
+    offsets = range(0, len(text), 500)
+    consumed = []
+    chunks = (consumed.append(i) or text[i:i + 500] for i in offsets)
+    records = {}
+    for key, value in parser.iterparse(chunks):
+        assert isinstance(key, str)
+        if not records:
+            # the first record is emitted before the whole statement is read
+            assert len(consumed) < len(offsets)
+        if key in expected and isinstance(expected[key], list):
+            records.setdefault(key, []).append(value)
+        else:
+            records[key] = value
+    assert records == expected
+
+
+def splitGbk(text: str, size: int) -> list[bytes]:
+    """split the GBK bytes of text into chunks of size bytes, like the Content of OnRspQrySettlementInfo"""
+    raw = text.encode("gbk")
+    return [raw[i:i + size] for i in range(0, len(raw), size)]
+
+
+def testDecodeSplitCharacter():
+    text = "交易结算单(盯市) Settlement Statement(MTM)"
+    raw = text.encode("gbk")
+    # the first chunk ends with the lead byte of "易"
+    split = len("交".encode("gbk")) + 1
+    assert raw[:split].decode("gbk", errors="ignore") == "交"
+
+    chunks = [(raw[:split], False), (raw[split:], True)]
+    assert "".join(decodeSettlementChunks(chunks)) == text
+
+    # a str chunk keeps the split byte as a surrogate, as the binding decodes with surrogateescape
+    chunks = [(raw[:split].decode("gbk", errors="surrogateescape"), False),
+              (raw[split:].decode("gbk", errors="surrogateescape"), True)]
+    assert "".join(decodeSettlementChunks(chunks)) == text
+
+    # a str chunk whose split byte was already replaced cannot be recovered
+    chunks = [(raw[:split].decode("gbk", errors="replace"), False), (raw[split:], True)]
+    assert "\ufffd" in "".join(decodeSettlementChunks(chunks))
+
+
+def testDecodeSampleChunks():
+    with open("sample.out", encoding="utf-8", newline="") as f:
+        text = f.read()
+    chunks = splitGbk(text, 500)
+    assert any(chunk.decode("gbk", errors="ignore").encode("gbk") != chunk for chunk in chunks)
+    contents = [chunk.decode("gbk", errors="surrogateescape") for chunk in chunks]
+    assert "".join(decodeSettlementChunks((content, i == len(contents) - 1) for i, content in enumerate(contents))) == text
+
+
+def testSliceDetailRows():
+    from benchmark import LegacyTransactionsHandler, makeTransactionTable
+    lines = makeTransactionTable(12)
+    # the O/C cell of the last row is wider than the header, as in some real statements
+    lines[-4] = lines[-4].replace("|开                |", "|开                  |")
+    handler = TransactionsHandler()
+    records = handler.parse(lines)[TransactionsHandler.KEY]
+    assert records == LegacyTransactionsHandler().parse(lines)[TransactionsHandler.KEY]
+    assert records[-1]["OffsetFlag"] == "0" and records[-1]["TradeID"] == "11"
+
+
 if __name__ == "__main__":
     testSettlementParser()
+    testIterParse()
+    testDecodeSplitCharacter()
+    testDecodeSampleChunks()
+    testSliceDetailRows()
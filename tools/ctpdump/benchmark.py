@@ -0,0 +1,36 @@
+"""
+ctpdump记录类型内存占用对比: 普通dataclass与__slots__版本的每条记录字节数
+
+usage: python benchmark.py [count]
+"""
+
+import sys
+import tracemalloc
+from dataclasses import fields, make_dataclass, asdict
+
+from ctpdump import InvestorPositionField, OrderField, TradeField, DepthMarketDataField
+
+
+def plain_variant(cls):
+    """同名同字段的普通dataclass, 作为对比基准"""
+    return make_dataclass(cls.__name__, [(f.name, f.type, f.default) for f in fields(cls)])
+
+
+def per_record_size(cls, count: int) -> float:
+    values = [f.default for f in fields(cls)]
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    records = [cls(*values) for _ in range(count)]
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert asdict(records[0]) == asdict(cls(*values))
+    return (end - start) / count
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print(f"{'class':<24}{'fields':>8}{'dataclass':>12}{'slots':>12}{'saved':>10}")
+    for cls in (InvestorPositionField, OrderField, TradeField, DepthMarketDataField):
+        before = per_record_size(plain_variant(cls), count)
+        after = per_record_size(cls, count)
+        print(f"{cls.__name__:<24}{len(fields(cls)):>8}{before:>12.1f}{after:>12.1f}{1 - after / before:>10.1%}")
@@ -4,19 +4,37 @@ last modify: 2024/5/2
 """
 
 
+import argparse
+import csv
 import json
+import os
 import sys
 import threading
 import time
-from dataclasses import dataclass, asdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, asdict, fields
+from functools import partial
+from operator import attrgetter
+from typing import NewType
 from openctp_ctp import tdapi
 #import thosttraderapi as tdapi
 
+# 单字符枚举字段(如买卖方向、报单状态), 列式输出时按字典编码
+Char = NewType("Char", str)
 
-def adjust_price(price: float) -> float:
-    if price == sys.float_info.max:
-        price = 0
-    return price
+def record(cls):
+    """
+    数量较大的记录类型使用__slots__, 实例不再携带__dict__;
+    python3.10以下的dataclass不支持slots参数, 按同样的方式重建一个带__slots__的类
+    """
+    if sys.version_info >= (3, 10):
+        return dataclass(slots=True)(cls)
+    cls = dataclass(cls)
+    names = tuple(f.name for f in fields(cls))
+    # 字段默认值已在生成的__init__中, 类属性会与同名的__slots__冲突
+    namespace = {key: value for key, value in cls.__dict__.items() if key not in names + ("__dict__", "__weakref__")}
+    namespace["__slots__"] = names
+    return type(cls)(cls.__name__, cls.__bases__, namespace)
 
 
 @dataclass
@@ -24,7 +42,7 @@ class Instrument:
     InstrumentID: str
     InstrumentName: str
     ExchangeID: str
-    ProductClass: str
+    ProductClass: Char
     ProductID: str
     PriceTick: float
 
@@ -41,15 +59,15 @@ class Product:
     ProductName: str
 
 
-@dataclass
+@record
 class InvestorPositionField:
     """投资者持仓"""
 
     BrokerID: str = ""  # 经纪公司代码
     InvestorID: str = ""  # 投资者代码
-    PosiDirection: str = ""  # 持仓多空方向
-    HedgeFlag: str = ""  # 投机套保标志
-    PositionDate: str = ""  # 持仓日期
+    PosiDirection: Char = ""  # 持仓多空方向
+    HedgeFlag: Char = ""  # 投机套保标志
+    PositionDate: Char = ""  # 持仓日期
     YdPosition: int = 0  # 上日持仓
     Position: int = 0  # 今日持仓
     LongFrozen: int = 0  # 多头冻结
@@ -146,12 +164,12 @@ class TradingAccountField:
     SpecProductCloseProfit: float = 0.0  # 特殊产品平仓盈亏
     SpecProductPositionProfitByAlg: float = 0.0  # 根据持仓盈亏算法计算的特殊产品持仓盈亏
     SpecProductExchangeMargin: float = 0.0  # 特殊产品交易所保证金
-    BizType: str = ""  # 业务类型
+    BizType: Char = ""  # 业务类型
     FrozenSwap: float = 0.0  # 延时换汇冻结金额
     RemainSwap: float = 0.0  # 剩余换汇额度
 
 
-@dataclass
+@record
 class OrderField:
     """报单"""
 
@@ -159,19 +177,19 @@ class OrderField:
     InvestorID: str = ""  # 投资者代码
     OrderRef: str = ""  # 报单引用
     UserID: str = ""  # 用户代码
-    OrderPriceType: str = ""  # 报单价格条件
-    Direction: str = ""  # 买卖方向
+    OrderPriceType: Char = ""  # 报单价格条件
+    Direction: Char = ""  # 买卖方向
     CombOffsetFlag: str = ""  # 组合开平标志
     CombHedgeFlag: str = ""  # 组合投机套保标志
     LimitPrice: float = 0.0  # 价格
     VolumeTotalOriginal: int = 0  # 数量
-    TimeCondition: str = ""  # 有效期类型
+    TimeCondition: Char = ""  # 有效期类型
     GTDDate: str = ""  # GTD日期
-    VolumeCondition: str = ""  # 成交量类型
+    VolumeCondition: Char = ""  # 成交量类型
     MinVolume: int = 0  # 最小成交量
-    ContingentCondition: str = ""  # 触发条件
+    ContingentCondition: Char = ""  # 触发条件
     StopPrice: float = 0.0  # 止损价
-    ForceCloseReason: str = ""  # 强平原因
+    ForceCloseReason: Char = ""  # 强平原因
     IsAutoSuspend: int = 0  # 自动挂起标志
     BusinessUnit: str = ""  # 业务单元
     RequestID: int = 0  # 请求编号
@@ -181,14 +199,14 @@ class OrderField:
     ClientID: str = ""  # 客户代码
     TraderID: str = ""  # 交易所交易员代码
     InstallID: int = 0  # 安装编号
-    OrderSubmitStatus: str = ""  # 报单提交状态
+    OrderSubmitStatus: Char = ""  # 报单提交状态
     NotifySequence: int = 0  # 报单提示序号
     TradingDay: str = ""  # 交易日
     SettlementID: int = 0  # 结算编号
     OrderSysID: str = ""  # 报单编号
-    OrderSource: str = ""  # 报单来源
-    OrderStatus: str = ""  # 报单状态
-    OrderType: str = ""  # 报单类型
+    OrderSource: Char = ""  # 报单来源
+    OrderStatus: Char = ""  # 报单状态
+    OrderType: Char = ""  # 报单类型
     VolumeTraded: int = 0  # 今成交数量
     VolumeTotal: int = 0  # 剩余数量
     InsertDate: str = ""  # 报单日期
@@ -220,7 +238,7 @@ class OrderField:
     IPAddress: str = ""  # IP地址
 
 
-@dataclass
+@record
 class TradeField:
     """成交"""
 
@@ -230,19 +248,19 @@ class TradeField:
     UserID: str = ""  # 用户代码
     ExchangeID: str = ""  # 交易所代码
     TradeID: str = ""  # 成交编号
-    Direction: str = ""  # 买卖方向
+    Direction: Char = ""  # 买卖方向
     OrderSysID: str = ""  # 报单编号
     ParticipantID: str = ""  # 会员代码
     ClientID: str = ""  # 客户代码
-    TradingRole: str = ""  # 交易角色
-    OffsetFlag: str = ""  # 开平标志
-    HedgeFlag: str = ""  # 投机套保标志
+    TradingRole: Char = ""  # 交易角色
+    OffsetFlag: Char = ""  # 开平标志
+    HedgeFlag: Char = ""  # 投机套保标志
     Price: float = 0.0  # 价格
     Volume: int = 0  # 数量
     TradeDate: str = ""  # 成交时期
     TradeTime: str = ""  # 成交时间
-    TradeType: str = ""  # 成交类型
-    PriceSource: str = ""  # 成交价来源
+    TradeType: Char = ""  # 成交类型
+    PriceSource: Char = ""  # 成交价来源
     TraderID: str = ""  # 交易所交易员代码
     OrderLocalID: str = ""  # 本地报单编号
     ClearingPartID: str = ""  # 结算会员编号
@@ -251,13 +269,13 @@ class TradeField:
     TradingDay: str = ""  # 交易日
     SettlementID: int = 0  # 结算编号
     BrokerOrderSeq: int = 0  # 经纪公司报单编号
-    TradeSource: str = ""  # 成交来源
+    TradeSource: Char = ""  # 成交来源
     InvestUnitID: str = ""  # 投资单元代码
     InstrumentID: str = ""  # 合约代码
     ExchangeInstID: str = ""  # 合约在交易所的代码
 
 
-@dataclass
+@record
 class DepthMarketDataField:
     """深度行情"""
 
@@ -309,81 +327,481 @@ class DepthMarketDataField:
     BandingLowerPrice: float = 0.0  # 下带价
 
 
-def convert_field(src_instance, dst_field_class):
-    dst_instance = dst_field_class()
-
+class QueryScheduler(object):
+    """查询调度: 上一个查询收到bIsLast后立即发送下一个, 不超过每秒rate个请求。
+    遇到流控(-2: 未处理请求超限, -3: 每秒请求超限)时间隔加倍, 请求成功后逐步恢复。
+    """
+
+    FLOW_CONTROL = (-2, -3)
+
+    def __init__(self, rate: float = 1.0, max_interval: float = 8.0):
+        self.base_interval = 1.0 / rate if rate > 0 else 0.0
+        self.max_interval = max_interval
+        self.interval = self.base_interval
+        self._last_sent = 0.0
+
+    def send(self, request) -> int:
+        while True:
+            wait = self._last_sent + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            ret = request()
+            self._last_sent = time.monotonic()
+            if ret not in self.FLOW_CONTROL:
+                self.interval = max(self.base_interval, self.interval / 2)
+                return ret
+            self.interval = min(self.max_interval, max(self.interval * 2, 0.1))
+            print(f"{request.__name__} flow control, ret={ret}, retry in {self.interval:.2f}s", file=sys.stderr)
+
+    def query(self, request, wait):
+        """Send the request and call `wait` to block until its last response."""
+        ret = self.send(request)
+        if ret != 0:
+            raise RuntimeError(f"{request.__name__} failed, ret={ret}")
+        wait()
+
+
+class JsonWriter(object):
+    """每个分类输出为一个json数组, 每条记录在回调中到达时立即写出, 不在内存中缓存。
+    未指定目录时按分类依次输出到stdout, 否则每个分类写入 <directory>/<category>.json
+    """
+
+    EXT = "json"
+
+    def __init__(self, directory: str = None):
+        self.directory = directory
+        self._fp = None
+        self._count = 0
+
+    def _open(self, category: str, append: bool = False):
+        if self.directory is None:
+            sys.stdout.write(f"{category}:\n")
+            return sys.stdout
+        return open(os.path.join(self.directory, f"{category}.{self.EXT}"), "a" if append else "w", encoding="utf-8")
+
+    def begin(self, category: str, record_class, append: bool = False):
+        self._fp = self._open(category)
+        self._fp.write("[")
+        self._count = 0
+
+    def write(self, record):
+        if self._count:
+            self._fp.write(",\n")
+        self._fp.write(json.dumps(asdict(record), ensure_ascii=False))
+        self._count += 1
+
+    def end(self):
+        self._fp.write("]\n")
+        self._close()
+
+    def _close(self):
+        if self._fp is not sys.stdout:
+            self._fp.close()
+        self._fp = None
+
+
+class NdjsonWriter(JsonWriter):
+    """每个分类写入 <directory>/<category>.ndjson, 每行一条记录"""
+
+    EXT = "ndjson"
+
+    def begin(self, category: str, record_class, append: bool = False):
+        self._path = os.path.join(self.directory, f"{category}.{self.EXT}")
+        self._start = os.path.getsize(self._path) if append and os.path.exists(self._path) else 0
+        self._fp = self._open(category, append)
+
+    def write(self, record):
+        self._fp.write(json.dumps(asdict(record), ensure_ascii=False))
+        self._fp.write("\n")
+
+    def end(self):
+        self._close()
+
+    def rollback(self):
+        """丢弃本分类begin之后写出的记录"""
+        self._fp.truncate(self._start)
+        self._close()
+        if not self._start:
+            os.remove(self._path)
+
+
+class CsvWriter(object):
+    """每个分类写入 <directory>/<category>.csv, 表头为dataclass字段名"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._fp = None
+        self._writer = None
+        self._getter = None
+
+    def begin(self, category: str, record_class, append: bool = False):
+        names = [f.name for f in fields(record_class)]
+        self._getter = attrgetter(*names)
+        path = self._path = os.path.join(self.directory, f"{category}.csv")
+        append = append and os.path.exists(path)
+        self._start = os.path.getsize(path) if append else 0
+        self._fp = open(path, "a" if append else "w", encoding="utf-8", newline="")
+        self._writer = csv.writer(self._fp)
+        if not append:
+            self._writer.writerow(names)
+
+    def write(self, record):
+        self._writer.writerow(self._getter(record))
+
+    def end(self):
+        self._fp.close()
+        self._fp = None
+
+    def rollback(self):
+        """丢弃本分类begin之后写出的记录, 新建的文件连同表头一起删除"""
+        self._fp.truncate(self._start)
+        self.end()
+        if not self._start:
+            os.remove(self._path)
+
+
+class ArrowWriter(object):
+    """每个分类写入一个列式文件: <category>.parquet 或 <category>.arrow(Arrow IPC文件, 可零拷贝读取)。
+    schema由dataclass注解生成: float->float64, int->int64, str->string, Char->字典编码string,
+    每BATCH_SIZE条记录写出一个batch
+    """
+
+    BATCH_SIZE = 65536
+
+    def __init__(self, directory: str, fmt: str = "parquet"):
+        # pyarrow是否安装在main中检查
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.directory = directory
+        self.fmt = fmt
+        self._types = {
+            float: pyarrow.float64(),
+            int: pyarrow.int64(),
+            str: pyarrow.string(),
+            Char: pyarrow.dictionary(pyarrow.int8(), pyarrow.string()),
+        }
+        # 所有分类共用一个固定字典, 各batch的字典相同, IPC文件无需字典替换
+        self._chars = [""] + [chr(c) for c in range(32, 127)]
+        self._char_index = {c: i for i, c in enumerate(self._chars)}
+        self._char_dictionary = pyarrow.array(self._chars, pyarrow.string())
+
+    def begin(self, category: str, record_class, append: bool = False):
+        pa = self.pa
+        self._fields = fields(record_class)
+        self._getter = attrgetter(*[f.name for f in self._fields])
+        self._schema = pa.schema([(f.name, self._types[f.type]) for f in self._fields])
+        self._rows = []
+        path = os.path.join(self.directory, f"{category}.{self.fmt}")
+        if self.fmt == "parquet":
+            self._file = pa.parquet.ParquetWriter(path, self._schema)
+        else:
+            self._file = pa.ipc.new_file(path, self._schema)
+
+    def write(self, record):
+        self._rows.append(self._getter(record))
+        if len(self._rows) >= self.BATCH_SIZE:
+            self._flush()
+
+    def end(self):
+        self._flush()
+        self._file.close()
+        self._file = None
+
+    def _flush(self):
+        if not self._rows:
+            return
+        pa = self.pa
+        arrays = []
+        for f, column in zip(self._fields, zip(*self._rows)):
+            if f.type is Char:
+                indices = pa.array([self._char_index.get(v, 0) for v in column], pa.int8())
+                arrays.append(pa.DictionaryArray.from_arrays(indices, self._char_dictionary))
+            else:
+                arrays.append(pa.array(column, self._types[f.type]))
+        self._file.write_batch(pa.record_batch(arrays, schema=self._schema))
+        self._rows = []
+
+
+WRITERS = {
+    "json": JsonWriter,
+    "ndjson": NdjsonWriter,
+    "csv": CsvWriter,
+    "parquet": partial(ArrowWriter, fmt="parquet"),
+    "arrow": partial(ArrowWriter, fmt="arrow"),
+}
+
+
+class IncrementalState(object):
+    """增量导出状态: 按交易所记录已导出报单/成交的最大SequenceNo及其时间。
+    下次运行时以这些时间设置InsertTimeStart/TradeTimeStart, 并只追加SequenceNo更大的记录。
+    交易日变化后状态自动清空, 重新全量导出。
+    """
+
+    TIME_KEYS = {"Orders": "InsertTime", "Trades": "TradeTime"}
+    # 夜盘时间在字符串比较上小于日盘, 仅当已导出的最新记录都在日盘时才按时间过滤
+    DAY_SESSION = ("08:00:00", "16:00:00")
+
+    def __init__(self, path: str):
+        self.path = path
+        self.continuing = False
+        self.state = {"TradingDay": ""}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fp:
+                self.state = json.load(fp)
+
+    def reset(self, trading_day: str):
+        self.continuing = self.state.get("TradingDay") == trading_day
+        if not self.continuing:
+            self.state = {"TradingDay": trading_day}
+        for category in self.TIME_KEYS:
+            self.state.setdefault(category, {})
+        # 本次运行开始时的状态, 分类导出失败时恢复
+        self._saved = {category: dict(self.state[category]) for category in self.TIME_KEYS}
+        # 上次运行导出的最大序号, 本次查询结果不保证按序号到达
+        self._exported = {category: {exchange: last["SequenceNo"] for exchange, last in self.state[category].items()}
+                          for category in self.TIME_KEYS}
+
+    def start_time(self, category: str) -> str:
+        times = [last["Time"] for last in self.state[category].values()]
+        if not times or not all(self.DAY_SESSION[0] <= t < self.DAY_SESSION[1] for t in times):
+            return ""
+        return min(times)
+
+    def accept(self, category: str, record) -> bool:
+        exported = self._exported[category].get(record.ExchangeID)
+        if exported is not None and record.SequenceNo <= exported:
+            return False
+        last = self.state[category].get(record.ExchangeID)
+        if last is None or record.SequenceNo > last["SequenceNo"]:
+            self.state[category][record.ExchangeID] = {
+                "SequenceNo": record.SequenceNo,
+                "Time": getattr(record, self.TIME_KEYS[category]),
+            }
+        return True
+
+    def rollback(self, category: str):
+        """分类导出失败时恢复该分类的状态, 与写出器丢弃的记录一致"""
+        self.state[category] = dict(self._saved[category])
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            json.dump(self.state, fp, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+
+class ReferenceCache(object):
+    """交易所、品种、合约等参考数据缓存, 每个交易日最多变化一次, 按 broker + TradingDay 保存在 <directory>/<broker>_<TradingDay>.json"""
+
+    CATEGORIES = ("Exchanges", "Products", "Instruments")
+
+    def __init__(self, directory: str, refresh: bool = False):
+        self.directory = directory
+        self.refresh = refresh
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, broker: str, trading_day: str) -> str:
+        return os.path.join(self.directory, f"{broker}_{trading_day}.json")
+
+    def load(self, broker: str, trading_day: str) -> dict:
+        path = self._path(broker, trading_day)
+        if self.refresh or not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as fp:
+            return json.load(fp)
+
+    def save(self, broker: str, trading_day: str, records: dict):
+        path = self._path(broker, trading_day)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fp:
+            json.dump({category: [asdict(record) for record in records[category]] for category in self.CATEGORIES},
+                      fp, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+# 无效价格为DBL_MAX, 转换时置为0
+MARKET_DATA_PRICE_FIELDS = (
+    "PreSettlementPrice", "PreClosePrice", "LastPrice", "OpenPrice", "ClosePrice", "LowestPrice", "AveragePrice",
+    "HighestPrice", "SettlementPrice", "CurrDelta", "PreDelta", "BandingLowerPrice", "BandingUpperPrice",
+    "AskPrice1", "AskPrice2", "AskPrice3", "AskPrice4", "AskPrice5",
+    "BidPrice1", "BidPrice2", "BidPrice3", "BidPrice4", "BidPrice5",
+)
+
+_converters = {}
+
+
+def make_converter(src_class, dst_field_class, adjust_fields=()):
+    """根据dst_field_class的字段一次性生成转换函数: 用attrgetter批量取值, 再按位置构造实例"""
+    names = tuple(f.name for f in fields(dst_field_class) if hasattr(src_class, f.name))
+    getter = attrgetter(*names)
+    if len(names) == 1:
+        getter = lambda src, _get=getter: (_get(src),)
+    adjust_idx = tuple(names.index(name) for name in adjust_fields if name in names)
+    positional = len(names) == len(fields(dst_field_class))
+    invalid = sys.float_info.max
+
+    def convert(src_instance):
+        values = getter(src_instance)
+        if adjust_idx:
+            values = list(values)
+            for i in adjust_idx:
+                if values[i] == invalid:
+                    values[i] = 0
+        if positional:
+            return dst_field_class(*values)
+        # 旧版本API缺少的字段保留默认值
+        return dst_field_class(**dict(zip(names, values)))
+
+    return convert
+
+
+def convert_field(src_instance, dst_field_class, adjust_fields=()):
     if src_instance is None:
-        return dst_instance
+        return dst_field_class()
 
-    for k in src_instance.__annotations__.keys():
-        setattr(dst_instance, k, getattr(src_instance, k))
-    return dst_instance
+    key = (type(src_instance), dst_field_class)
+    converter = _converters.get(key)
+    if converter is None:
+        converter = _converters[key] = make_converter(type(src_instance), dst_field_class, adjust_fields)
+    return converter(src_instance)
 
 
 class CTPDump(tdapi.CThostFtdcTraderSpi):
-    def __init__(self, host, broker, user, password, appid, authcode):
+    def __init__(self, host, broker, user, password, appid, authcode, writer=None, state: IncrementalState = None,
+                 flow_path: str = "", cache: ReferenceCache = None, timeout: float = None):
         self.broker = broker
         self.user = user
         self.password = password
         self.appid = appid
         self.authcode = authcode
-
-        self.Exchanges = []
-        self.Products = []
-        self.Instruments = []
-        self.Positions = []
-        self.TradingAccount = []
-        self.Orders = []
-        self.Trades = []
-        self.MarketData = []
+        self.writer = writer or JsonWriter()
+        self.state = state
+        self.cache = cache
+        self.trading_day = ""
+        self._collected = None
+        self.semaphore = threading.Semaphore(0)
+        self.error = None
+        # 等待登录或单个查询完成的最长时间(秒), None为一直等待
+        self.timeout = timeout
+        # Run之后到Release之前断线时, 正在等待的登录或查询不会再有响应
+        self.active = False
 
         tdapi.CThostFtdcTraderSpi.__init__(self)
-        self.api: tdapi.CThostFtdcTraderApi = tdapi.CThostFtdcTraderApi.CreateFtdcTraderApi()
+        self.api: tdapi.CThostFtdcTraderApi = tdapi.CThostFtdcTraderApi.CreateFtdcTraderApi(flow_path)
         self.api.RegisterSpi(self)
         self.api.RegisterFront(host)
 
     def Run(self):
+        self.active = True
         self.api.Init()
 
+    def Release(self):
+        self.active = False
+        self.api.Release()
+
+    def Fail(self, msg: str):
+        """记录错误并唤醒等待中的线程, 由Wait抛出"""
+        self.error = msg
+        self.semaphore.release()
+
+    def Wait(self):
+        """等待登录或当前查询完成"""
+        if not self.semaphore.acquire(timeout=self.timeout):
+            raise RuntimeError(f"no response in {self.timeout}s")
+        if self.error is not None:
+            raise RuntimeError(self.error)
+
+    def Dump(self, scheduler: QueryScheduler):
+        if self.state is not None:
+            self.state.reset(self.trading_day)
+        cached = self.cache.load(self.broker, self.trading_day) if self.cache is not None else {}
+        collected = {}
+        for category, record_class, request in (
+                ("Exchanges", Exchange, self.QryExchange),
+                ("Products", Product, self.QryProduct),
+                ("Instruments", Instrument, self.QryInstrument),
+                ("DepthMarketData", DepthMarketDataField, self.QryDepthMarketData),
+                ("Account", TradingAccountField, self.QryTradingAccount),
+                ("Positions", InvestorPositionField, self.QryPosition),
+                ("Orders", OrderField, self.QryOrder),
+                ("Trades", TradeField, self.QryTrade),
+        ):
+            incremental = self.state is not None and category in IncrementalState.TIME_KEYS
+            self.writer.begin(category, record_class, incremental and self.state.continuing)
+            try:
+                if category in cached:
+                    for item in cached[category]:
+                        self.writer.write(record_class(**item))
+                else:
+                    if self.cache is not None and category in ReferenceCache.CATEGORIES:
+                        self._collected = collected[category] = []
+                    scheduler.query(request, self.Wait)
+            except BaseException:
+                if incremental:
+                    # 丢弃本分类已追加的记录并恢复状态, 下次运行重新导出
+                    self.writer.rollback()
+                    self.state.rollback(category)
+                else:
+                    self.writer.end()
+                raise
+            finally:
+                self._collected = None
+            self.writer.end()
+            if incremental:
+                # 记录写出后立即保存状态, 之后的分类失败时下次运行不会重复追加
+                self.state.save()
+        if len(collected) == len(ReferenceCache.CATEGORIES):
+            self.cache.save(self.broker, self.trading_day, collected)
+
+    def Write(self, record):
+        self.writer.write(record)
+        if self._collected is not None:
+            self._collected.append(record)
+
     def QryInstrument(self):
         req = tdapi.CThostFtdcQryInstrumentField()
-        self.api.ReqQryInstrument(req, 0)
+        return self.api.ReqQryInstrument(req, 0)
 
     def QryExchange(self):
         req = tdapi.CThostFtdcQryExchangeField()
-        self.api.ReqQryExchange(req, 0)
+        return self.api.ReqQryExchange(req, 0)
 
     def QryProduct(self):
         req = tdapi.CThostFtdcQryProductField()
-        self.api.ReqQryProduct(req, 0)
+        return self.api.ReqQryProduct(req, 0)
     
     def QryPosition(self):
         req = tdapi.CThostFtdcQryInvestorPositionField()
         req.BrokerID = self.broker
         req.InvestorID = self.user
-        self.api.ReqQryInvestorPosition(req, 0)
+        return self.api.ReqQryInvestorPosition(req, 0)
     
     def QryTradingAccount(self):
         req = tdapi.CThostFtdcQryTradingAccountField()
         req.BrokerID = self.broker
         req.InvestorID = self.user
-        self.api.ReqQryTradingAccount(req, 0)
+        return self.api.ReqQryTradingAccount(req, 0)
     
     def QryOrder(self):
         req = tdapi.CThostFtdcQryOrderField()
         req.BrokerID = self.broker
         req.InvestorID = self.user
-        self.api.ReqQryOrder(req, 0)
+        if self.state is not None:
+            req.InsertTimeStart = self.state.start_time("Orders")
+        return self.api.ReqQryOrder(req, 0)
     
     def QryTrade(self):
         req = tdapi.CThostFtdcQryTradeField()
         req.BrokerID = self.broker
         req.InvestorID = self.user
-        self.api.ReqQryTrade(req, 0)
+        if self.state is not None:
+            req.TradeTimeStart = self.state.start_time("Trades")
+        return self.api.ReqQryTrade(req, 0)
     
     def QryDepthMarketData(self):
         req = tdapi.CThostFtdcQryDepthMarketDataField()
-        self.api.ReqQryDepthMarketData(req, 0)
+        return self.api.ReqQryDepthMarketData(req, 0)
 
     def OnFrontConnected(self) -> "None":
         print("OnFrontConnected")
@@ -399,6 +817,8 @@ class CTPDump(tdapi.CThostFtdcTraderSpi):
 
     def OnFrontDisconnected(self, nReason: int) -> "None":
         print(f"OnFrontDisconnected.[nReason={nReason}]")
+        if self.active:
+            self.Fail(f"front disconnected, nReason={nReason}")
 
     def OnRspAuthenticate(
             self,
@@ -409,8 +829,8 @@ class CTPDump(tdapi.CThostFtdcTraderSpi):
     ):
         """客户端认证响应"""
         if pRspInfo and pRspInfo.ErrorID != 0:
-            print("认证失败：{}".format(pRspInfo.ErrorMsg))
-            exit(-1)
+            self.Fail("认证失败：{}".format(pRspInfo.ErrorMsg))
+            return
         print("Authenticate succeed.")
 
         # 登录
@@ -423,35 +843,36 @@ class CTPDump(tdapi.CThostFtdcTraderSpi):
 
     def OnRspUserLogin(self, pRspUserLogin: 'CThostFtdcRspUserLoginField', pRspInfo: 'CThostFtdcRspInfoField', nRequestID: 'int', bIsLast: 'bool') -> "None":
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"Login failed. {pRspInfo.ErrorMsg}")
-            exit(-1)
+            self.Fail(f"Login failed. {pRspInfo.ErrorMsg}")
+            return
         print(f"Login succeed. TradingDay: {pRspUserLogin.TradingDay}")
+        self.trading_day = pRspUserLogin.TradingDay
 
-        semaphore.release()
+        self.semaphore.release()
 
     def OnRspQryExchange(self, pExchange: "CThostFtdcExchangeField", pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int", bIsLast: "bool") -> "None":
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryExchange failed: {pRspInfo.ErrorMsg}")
-            exit(-1)
+            self.Fail(f"OnRspQryExchange failed: {pRspInfo.ErrorMsg}")
+            return
         # print(f"OnRspQryExchange:{pExchange.ExchangeID}, {pExchange.ExchangeName}")
 
         exchange = Exchange(ExchangeID = pExchange.ExchangeID, ExchangeName = pExchange.ExchangeName)
-        self.Exchanges.append(exchange)
+        self.Write(exchange)
 
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
 
     def OnRspQryProduct(self, pProduct: "CThostFtdcProductField", pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int", bIsLast: "bool") -> "None":
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryProduct failed: {pRspInfo.ErrorMsg}")
-            exit(-1)
+            self.Fail(f"OnRspQryProduct failed: {pRspInfo.ErrorMsg}")
+            return
         # print(f"OnRspQryProduct:{pProduct.ProductID}, {pProduct.ProductName}, {pProduct.ExchangeID}")
 
         product = Product(ProductID = pProduct.ProductID, ProductName = pProduct.ProductName)
-        self.Products.append(product)
+        self.Write(product)
 
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
 
     def OnRspQryInstrument(
         self,
@@ -461,8 +882,8 @@ class CTPDump(tdapi.CThostFtdcTraderSpi):
         bIsLast: "bool"
     ) -> "None":
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryInstrument failed: {pRspInfo.ErrorMsg}")
-            exit(-1)
+            self.Fail(f"OnRspQryInstrument failed: {pRspInfo.ErrorMsg}")
+            return
         # print(f"OnRspQryInstrument:{pInstrument.InstrumentID}, {pInstrument.InstrumentName}, ExchangeID:{pInstrument.ExchangeID}")
 
         instrument = Instrument(InstrumentID = pInstrument.InstrumentID,
@@ -471,179 +892,146 @@ class CTPDump(tdapi.CThostFtdcTraderSpi):
                                 ProductClass = pInstrument.ProductClass,
                                 ExchangeID = pInstrument.ExchangeID,
                                 PriceTick = pInstrument.PriceTick)
-        self.Instruments.append(instrument)
+        self.Write(instrument)
 
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
     
     def OnRspQryInvestorPosition(self, pInvestorPosition, pRspInfo, nRequestID, bIsLast):
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f'OnRspQryInvestorPosition failed: {pRspInfo.ErrorMsg}')
-            exit(-1)
+            self.Fail(f'OnRspQryInvestorPosition failed: {pRspInfo.ErrorMsg}')
+            return
         
         if pInvestorPosition:
             position = convert_field(pInvestorPosition, InvestorPositionField)
-            self.Positions.append(position)
+            self.writer.write(position)
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
     
     def OnRspQryOrder(self, pOrder, pRspInfo, nRequestID, bIsLast):
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f'OnRspQryOrder failed: {pRspInfo.ErrorMsg}')
-            exit(-1)
+            self.Fail(f'OnRspQryOrder failed: {pRspInfo.ErrorMsg}')
+            return
         
         if pOrder:
             order = convert_field(pOrder, OrderField)
-            self.Orders.append(order)
+            if self.state is None or self.state.accept("Orders", order):
+                self.writer.write(order)
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
 
     def OnRspQryTrade(self, pTrade, pRspInfo, nRequestID, bIsLast):
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f'OnRspQryTrade failed: {pRspInfo.ErrorMsg}')
-            exit(-1)
+            self.Fail(f'OnRspQryTrade failed: {pRspInfo.ErrorMsg}')
+            return
             
         if pTrade:
             trade = convert_field(pTrade, TradeField)
-            self.Trades.append(trade)
+            if self.state is None or self.state.accept("Trades", trade):
+                self.writer.write(trade)
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
     
     def OnRspQryTradingAccount(self, pTradingAccount, pRspInfo, nRequestID, bIsLast):
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f'OnRspQryTradingAccount failed: {pRspInfo.ErrorMsg}')
-            exit(-1)
+            self.Fail(f'OnRspQryTradingAccount failed: {pRspInfo.ErrorMsg}')
+            return
         
         if pTradingAccount:
             account = convert_field(pTradingAccount, TradingAccountField)
-            self.TradingAccount.append(account)
+            self.writer.write(account)
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
     
     def OnRspQryDepthMarketData(self, pDepthMarketData, pRspInfo, nRequestID, bIsLast):
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f'OnRspQryDepthMarketData failed: {pRspInfo.ErrorMsg}')
-            exit(-1)
+            self.Fail(f'OnRspQryDepthMarketData failed: {pRspInfo.ErrorMsg}')
+            return
         if pDepthMarketData:
-            data = convert_field(pDepthMarketData, DepthMarketDataField)
-            data.PreSettlementPrice = adjust_price(data.PreSettlementPrice)
-            data.PreClosePrice = adjust_price(data.PreClosePrice)
-            data.LastPrice = adjust_price(data.LastPrice)
-            data.OpenPrice = adjust_price(data.OpenPrice)
-            data.ClosePrice = adjust_price(data.ClosePrice)
-            data.LowestPrice = adjust_price(data.LowestPrice)
-            data.AveragePrice = adjust_price(data.AveragePrice)
-            data.HighestPrice = adjust_price(data.HighestPrice)
-            data.SettlementPrice = adjust_price(data.SettlementPrice)
-            data.CurrDelta = adjust_price(data.CurrDelta)
-            data.PreDelta = adjust_price(data.PreDelta)
-            data.BandingLowerPrice = adjust_price(data.BandingLowerPrice)
-            data.BandingUpperPrice = adjust_price(data.BandingUpperPrice)
-            data.AskPrice1 = adjust_price(data.AskPrice1)
-            data.AskPrice2 = adjust_price(data.AskPrice2)
-            data.AskPrice3 = adjust_price(data.AskPrice3)
-            data.AskPrice4 = adjust_price(data.AskPrice4)
-            data.AskPrice5 = adjust_price(data.AskPrice5)
-            data.BidPrice1 = adjust_price(data.BidPrice1)
-            data.BidPrice2 = adjust_price(data.BidPrice2)
-            data.BidPrice3 = adjust_price(data.BidPrice3)
-            data.BidPrice4 = adjust_price(data.BidPrice4)
-            data.BidPrice5 = adjust_price(data.BidPrice5)
-            self.MarketData.append(data)
+            data = convert_field(pDepthMarketData, DepthMarketDataField, MARKET_DATA_PRICE_FIELDS)
+            self.writer.write(data)
         if bIsLast is True:
-            semaphore.release()
+            self.semaphore.release()
+
+
+def dump_account(account: dict, args, cache: ReferenceCache = None) -> None:
+    """配置文件模式下导出单个账户, 输出到 <output>/<broker>_<user>/"""
+    directory = os.path.join(args.output, f"{account['broker']}_{account['user']}")
+    os.makedirs(directory, exist_ok=True)
+    state = IncrementalState(os.path.join(directory, os.path.basename(args.state))) if args.state else None
+    ctpdump = CTPDump(account["host"], account["broker"], account["user"], account["password"],
+                      account.get("appid", ""), account.get("authcode", ""),
+                      WRITERS[args.format](directory), state, directory + os.sep, cache, args.timeout)
+    try:
+        ctpdump.Run()
+        ctpdump.Wait()
+        ctpdump.Dump(QueryScheduler(args.rate))
+    finally:
+        ctpdump.Release()
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 7:
-        print("Usage: {} host broker user password appid authcode".format(sys.argv[0]))
-        print("example: {} tcp://180.168.146.187:10130 9999 000001 888888 simnow_client_test 0000000000000000".format(sys.argv[0]))
-        exit(0)
-
-    semaphore = threading.Semaphore(0)
-
-    host = sys.argv[1]
-    broker = sys.argv[2]
-    user = sys.argv[3]
-    password = sys.argv[4]
-    appid = sys.argv[5]
-    authcode = sys.argv[6]
-    ctpdump = CTPDump(host,broker,user,password,appid,authcode)
+    parser = argparse.ArgumentParser(prog="ctpdump", description="Dump ctp instruments, prices, account, positions, orders and trades")
+    parser.add_argument("host", nargs="?", help="Trade server address, e.g. tcp://180.168.146.187:10130")
+    parser.add_argument("broker", nargs="?", help="Broker ID")
+    parser.add_argument("user", nargs="?", help="User ID")
+    parser.add_argument("password", nargs="?", help="Password")
+    parser.add_argument("appid", nargs="?", help="App ID")
+    parser.add_argument("authcode", nargs="?", help="Auth Code")
+    parser.add_argument("--rate", dest="rate", type=float, default=1.0, help="Max query requests per second of each account, default 1")
+    parser.add_argument("-o", "--output", dest="output", required=False, help="Output directory, one file per category. Print to stdout if not specified")
+    parser.add_argument("--format", dest="format", choices=WRITERS.keys(), default="json", help="Output file format, default json. parquet and arrow require pyarrow")
+    parser.add_argument("--state", dest="state", required=False, help="Incremental state file. Only orders and trades newer than the last run are queried and appended, requires --output and --format ndjson or csv")
+    parser.add_argument("--config", dest="config", required=False, help="Json account list to dump concurrently instead of the account on command line, requires --output")
+    parser.add_argument("--cache", dest="cache", required=False, help="Cache directory of exchanges, products and instruments, reused by later runs of the same broker and trading day")
+    parser.add_argument("--refresh", dest="refresh", action="store_true", default=False, help="Query exchanges, products and instruments again and refresh the cache")
+    parser.add_argument("--timeout", dest="timeout", type=float, default=60.0, help="Max seconds to wait for login or for each query to complete, default 60")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=4, help="Max accounts dumped at the same time with --config, default 4")
+    args = parser.parse_args()
+    if args.config is None and args.authcode is None:
+        parser.error("host broker user password appid authcode are required without --config")
+    if (args.output is None and args.format != "json") or (args.config and args.output is None):
+        parser.error(f"--format {args.format} and --config require --output")
+    if args.state and (args.output is None or args.format not in ("ndjson", "csv")):
+        parser.error("--state requires --output and --format ndjson or csv")
+    if args.refresh and not args.cache:
+        parser.error("--refresh requires --cache")
+    if args.format in ("parquet", "arrow"):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("please install pyarrow: pip install pyarrow")
+            exit(-1)
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    cache = ReferenceCache(args.cache, args.refresh) if args.cache else None
+
+    if args.config:
+        with open(args.config, encoding="utf-8") as fp:
+            accounts = json.load(fp)
+        failed = 0
+        with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+            futures = {executor.submit(dump_account, account, args, cache): account for account in accounts}
+            for future in as_completed(futures):
+                account = futures[future]
+                try:
+                    future.result()
+                    print(f"{account['broker']}_{account['user']} completed.")
+                except Exception as e:
+                    failed += 1
+                    print(f"{account['broker']}_{account['user']} failed: {e}")
+        exit(-1 if failed else 0)
+
+    writer = WRITERS[args.format](args.output)
+    state = IncrementalState(args.state) if args.state else None
+    ctpdump = CTPDump(args.host, args.broker, args.user, args.password, args.appid, args.authcode, writer, state,
+                      cache=cache, timeout=args.timeout)
     ctpdump.Run()
-
-    # waiting for login ok.
-    semaphore.acquire()
-
-    # query exchange
-    ctpdump.QryExchange()
-
-    # query product
-    time.sleep(1)
-    semaphore.acquire()
-    ctpdump.QryProduct()
-
-    # query instrument
-    time.sleep(1)
-    semaphore.acquire()
-    ctpdump.QryInstrument()
-
-    # query prices
-    time.sleep(1)
-    semaphore.acquire()
-    ctpdump.QryDepthMarketData()
-
-    # query positions
-    time.sleep(1)
-    semaphore.acquire()
-    ctpdump.QryPosition()
-
-    # query accounts
-    time.sleep(1)
-    semaphore.acquire()
-    ctpdump.QryTradingAccount()
-
-    # query orders
-    time.sleep(1)
-    semaphore.acquire()
-    ctpdump.QryOrder()
-
-    # query trades
-    time.sleep(1)
-    semaphore.acquire()
-    ctpdump.QryTrade()
-
-    # wait for completed.
-    semaphore.acquire()
-
-    print("Exchanges:")
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(exchange) for exchange in ctpdump.Exchanges])
-    print("[{}]".format(jsonstr))
-
-    print("Products:")
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(product) for product in ctpdump.Products])
-    print("[{}]".format(jsonstr))
-
-    print("Instruments:")
-    #print(json.dumps([instrument.__dict__ for instrument in ctpdump.Instruments]))
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(instrument) for instrument in ctpdump.Instruments])
-    print("[{}]".format(jsonstr))
-    
-    print("DepthMarketData:")
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(data) for data in ctpdump.MarketData])
-    print("[{}]".format(jsonstr))
-   
-    print("Account:")
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(data) for data in ctpdump.TradingAccount])
-    print("[{}]".format(jsonstr))
-
-    print("Positions:")
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(data) for data in ctpdump.Positions])
-    print("[{}]".format(jsonstr))
-
-    print("Orders:")
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(data) for data in ctpdump.Orders])
-    print("[{}]".format(jsonstr))
-
-    print("Trades:")
-    jsonstr = ',\n'.join(json.dumps(item, ensure_ascii=False) for item in [asdict(data) for data in ctpdump.Trades])
-    print("[{}]".format(jsonstr))
+    try:
+        # waiting for login ok.
+        ctpdump.Wait()
+        ctpdump.Dump(QueryScheduler(args.rate))
+    except RuntimeError as e:
+        print(e)
+        exit(-1)
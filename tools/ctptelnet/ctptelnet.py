@@ -5,21 +5,179 @@ author: krenx@openctp.
 last modify: 2024/5/2
 """
 
+import argparse
+import asyncio
+import json
+import os
+import re
 import sys
 import threading
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from collections import deque
+from concurrent.futures import Future
+from fnmatch import fnmatchcase
+from typing import Optional
+
 from openctp_ctp import tdapi
 
 
 # import thosttraderapi as tdapi
 
+class RspError(Exception):
+    """柜台返回的错误响应"""
+
+    def __init__(self, error_id: int, error_msg: str):
+        super().__init__(f"ErrorID={error_id}, ErrorMsg={error_msg}")
+        self.error_id = error_id
+        self.error_msg = error_msg
+
+
+class InstrumentIndex(object):
+    """
+    合约和品种的本地索引
+        合约代码排序后保存在列表中, 前缀查询(如 rb24*)用二分查找定位区间;
+        另按交易所、品种保存排序后的合约代码, 查询时从最小的候选集合开始过滤
+    """
+
+    # 品种类型的名称, 也可以直接使用ProductClass的取值
+    PRODUCT_CLASSES = {
+        "future": tdapi.THOST_FTDC_PC_Futures,
+        "option": tdapi.THOST_FTDC_PC_Options,
+        "combination": tdapi.THOST_FTDC_PC_Combination,
+        "spot": tdapi.THOST_FTDC_PC_Spot,
+        "efp": tdapi.THOST_FTDC_PC_EFP,
+        "spotoption": tdapi.THOST_FTDC_PC_SpotOption,
+    }
+
+    WILDCARD = re.compile(r"[*?\[]")
+
+    def __init__(self):
+        self.loaded = False
+        self._ids = []  # type: list[str]
+        self._instruments = {}  # type: dict[str, dict]
+        self._by_exchange = {}  # type: dict[str, list[str]]
+        self._by_product = {}  # type: dict[str, list[str]]
+        self._products = {}  # type: dict[tuple[str, str], dict]
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @staticmethod
+    def is_pattern(text: str) -> bool:
+        return InstrumentIndex.WILDCARD.search(text) is not None
+
+    def load(self, instruments: list[dict], products: list[dict]):
+        """用全量查询的结果重建索引"""
+        self._instruments = {record["InstrumentID"]: record for record in instruments}
+        self._ids = sorted(self._instruments)
+        self._by_exchange = {}
+        self._by_product = {}
+        for inst_id in self._ids:
+            record = self._instruments[inst_id]
+            self._by_exchange.setdefault(record["ExchangeID"], []).append(inst_id)
+            self._by_product.setdefault(record["ProductID"], []).append(inst_id)
+        self._products = {(record["ExchangeID"], record["ProductID"]): record for record in products}
+        self.loaded = True
+
+    def add(self, instruments: list[dict] = (), products: list[dict] = ()):
+        """加入索引之后柜台新增的合约或品种"""
+        for record in instruments:
+            inst_id = record["InstrumentID"]
+            if inst_id not in self._instruments:
+                insort(self._ids, inst_id)
+                insort(self._by_exchange.setdefault(record["ExchangeID"], []), inst_id)
+                insort(self._by_product.setdefault(record["ProductID"], []), inst_id)
+            self._instruments[inst_id] = record
+        for record in products:
+            self._products[(record["ExchangeID"], record["ProductID"])] = record
+
+    def search(self, instrument_id: str = "", exchange_id: str = "", product_id: str = "",
+               expire_date: str = "", product_class: str = "") -> list[dict]:
+        """
+        查询合约
+            instrument_id为合约代码或通配符(*, ?, [...]); expire_date为到期日的前缀, 如202410为当月到期;
+            product_class为品种类型的名称(future, option...)或取值; 空字符串表示不过滤
+        """
+        prefix = self.WILDCARD.split(instrument_id, maxsplit=1)[0]
+        if instrument_id and prefix == instrument_id:
+            ids = [instrument_id] if instrument_id in self._instruments else []
+        elif prefix:
+            ids = self._ids[bisect_left(self._ids, prefix):bisect_left(self._ids, prefix + "\U0010ffff")]
+        elif product_id:
+            ids = self._by_product.get(product_id, [])
+        elif exchange_id:
+            ids = self._by_exchange.get(exchange_id, [])
+        else:
+            ids = self._ids
+
+        # 前缀加 * 的区间即为结果, 其它通配符逐个匹配
+        wildcard = instrument_id not in (prefix, prefix + "*")
+        product_class = self.PRODUCT_CLASSES.get(product_class.lower(), product_class)
+        records = []
+        for inst_id in ids:
+            record = self._instruments[inst_id]
+            if wildcard and not fnmatchcase(inst_id, instrument_id):
+                continue
+            if exchange_id and record["ExchangeID"] != exchange_id:
+                continue
+            if product_id and record["ProductID"] != product_id:
+                continue
+            if expire_date and not record["ExpireDate"].startswith(expire_date):
+                continue
+            if product_class and record["ProductClass"] != product_class:
+                continue
+            records.append(record)
+        return records
+
+    def search_products(self, product_id: str = "", exchange_id: str = "") -> list[dict]:
+        """查询品种, product_id可以使用通配符"""
+        return [record for (exchange, product), record in sorted(self._products.items())
+                if (not exchange_id or exchange == exchange_id)
+                and (not product_id or fnmatchcase(product, product_id))]
+
+
 class CTPTelnet(tdapi.CThostFtdcTraderSpi):
-    def __init__(self, host, broker, user, password, appid, authcode):
+    """
+    每个Qry*查询使用独立的nRequestID, 返回在asyncio事件循环中等待的协程,
+    API线程收集该请求的响应记录, 收到bIsLast后以记录列表完成查询, 多个查询可以同时进行
+    """
+
+    # ReqQry*返回值: 未处理请求超过许可数 / 每秒发送请求数超过许可数
+    TOO_MANY_PENDING = -2
+    TOO_MANY_PER_SECOND = -3
+    # 流控时重发查询的间隔(秒)
+    RETRY_INTERVAL = 0.5
+
+    def __init__(self, host, broker, user, password, appid, authcode, qry_rate: float = 1.0):
         self.broker = broker
         self.user = user
         self.password = password
         self.appid = appid
         self.authcode = authcode
 
+        # 登录结果, True为登录成功
+        self.login = Future()
+        self.loop = None  # type: Optional[asyncio.AbstractEventLoop]
+        # Release后到达的回调不再转发给事件循环
+        self.released = False
+        self._lock = threading.Lock()
+        self._request_id = 0
+        self._pending = {}  # type: dict[int, tuple[asyncio.Future, list[dict]]]
+        self._sending = set()  # type: set[asyncio.Task]
+        # 每秒最多发送的查询数, 0为不限制
+        self.qry_rate = qry_rate
+        self._next_send = 0.0
+        # 连接、登录和回报等通知的输出
+        self.log = sys.stdout
+        # 合约和品种在首次查询时全量加载, 之后在本地查询
+        self.instruments = InstrumentIndex()
+        self._loading = None  # type: Optional[asyncio.Future]
+        # watch模式下报单和成交回报交给监控处理
+        self.monitor = None  # type: Optional[Monitor]
+        self.trading_day = ""
+
         tdapi.CThostFtdcTraderSpi.__init__(self)
         self.api: tdapi.CThostFtdcTraderApi = tdapi.CThostFtdcTraderApi.CreateFtdcTraderApi()
         self.api.RegisterSpi(self)
@@ -30,75 +188,211 @@ class CTPTelnet(tdapi.CThostFtdcTraderSpi):
     def Run(self):
         self.api.Init()
 
+    def Release(self):
+        """退出时释放API, 之后到达的回调直接丢弃"""
+        self.released = True
+        self.api.Release()
+
+    def _call_soon(self, callback, *args) -> bool:
+        """把API线程中的回调交给事件循环执行, 事件循环已关闭或API已释放时返回False"""
+        if self.released or self.loop is None:
+            return False
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            # 事件循环已关闭
+            return False
+        return True
+
+    def _next_request_id(self) -> int:
+        with self._lock:
+            self._request_id += 1
+            return self._request_id
+
+    def _request(self, send, req) -> asyncio.Future:
+        """
+        发送查询请求, 返回以该请求的全部响应记录完成的future; 遇到流控时稍后重发
+            future在事件循环处理到最后一条响应时完成, 此时之前收到的回报已处理, 之后收到的回报尚未处理
+        """
+        self.loop = asyncio.get_running_loop()
+        future = self.loop.create_future()
+        task = asyncio.ensure_future(self._send(send, req, future))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+        return future
+
+    async def _send(self, send, req, future: asyncio.Future):
+        while not future.done():
+            await self._throttle()
+            request_id = self._next_request_id()
+            with self._lock:
+                self._pending[request_id] = (future, [])
+            ret = send(req, request_id)
+            if ret == 0:
+                return
+            with self._lock:
+                del self._pending[request_id]
+            if ret not in (self.TOO_MANY_PENDING, self.TOO_MANY_PER_SECOND):
+                future.set_exception(RuntimeError(f"request failed: ret={ret}"))
+                return
+            await asyncio.sleep(self.RETRY_INTERVAL)
+
+    async def _throttle(self):
+        """按qry_rate为查询分配发送时刻, 在事件循环中执行, 分配时不会与其它查询交错"""
+        if not self.qry_rate:
+            return
+        now = time.monotonic()
+        send_at = max(now, self._next_send)
+        self._next_send = send_at + 1 / self.qry_rate
+        await asyncio.sleep(send_at - now)
+
+    def _collect(self, nRequestID: int, record: Optional[dict], pRspInfo, bIsLast: bool):
+        """在API线程中收集nRequestID的响应记录, 收到最后一条或错误时在事件循环中完成对应的future"""
+        error = None
+        with self._lock:
+            pending = self._pending.get(nRequestID)
+            if pending is None:
+                return
+            future, rows = pending
+            if pRspInfo is not None and pRspInfo.ErrorID != 0:
+                error = RspError(pRspInfo.ErrorID, pRspInfo.ErrorMsg)
+            elif record is not None:
+                rows.append(record)
+            if error is None and not bIsLast:
+                return
+            del self._pending[nRequestID]
+        self._call_soon(self._resolve, future, rows, error)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, rows: list[dict], error: Optional[Exception]):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(rows)
+
+    def _print(self, text: str):
+        """API线程中的输出交给事件循环打印, 避免与查询结果交错; watch模式下显示在监控屏幕中"""
+        if self.released:
+            return
+        if self.monitor is not None:
+            self._call_soon(self.monitor.notice, text)
+        elif not self._call_soon(lambda: print(text, file=self.log)):
+            print(text, file=self.log)
+
+    def _set_login(self, ok: bool):
+        if not self.login.done():
+            self.login.set_result(ok)
+
     def QryInstrument(self, exchangeid, productid, instrumentid):
         req = tdapi.CThostFtdcQryInstrumentField()
         req.ExchangeID = exchangeid
         req.ProductID = productid
         req.InstrumentID = instrumentid
-        self.api.ReqQryInstrument(req, 0)
+        return self._request(self.api.ReqQryInstrument, req)
+
+    async def LoadInstruments(self, refresh: bool = False) -> list[dict]:
+        """向柜台查询全部合约和品种并建立本地索引, 已加载时只在refresh时重新查询; 同时发起的加载共用一次查询"""
+        loading = self._loading
+        if loading is None or loading.done() and (refresh or loading.exception() is not None):
+            loading = self._loading = asyncio.ensure_future(self._load_instruments())
+        await asyncio.shield(loading)
+        return [{"Instruments": len(self.instruments), "Products": len(self.instruments.search_products())}]
+
+    async def _load_instruments(self):
+        instruments = await self.QryInstrument("", "", "")
+        products = await self.QryProduct("", "")
+        self.instruments.load(instruments, products)
+
+    async def FindInstrument(self, InstrumentID, ExchangeID, ProductID, ExpireDate, ProductClass) -> list[dict]:
+        """在本地索引中查询合约, 指定的合约代码不在索引中时再向柜台查询"""
+        await self.LoadInstruments()
+        args = (InstrumentID, ExchangeID, ProductID, ExpireDate, ProductClass)
+        records = self.instruments.search(*args)
+        if not records and InstrumentID and not self.instruments.is_pattern(InstrumentID):
+            self.instruments.add(instruments=await self.QryInstrument(ExchangeID, "", InstrumentID))
+            records = self.instruments.search(*args)
+        return records
+
+    async def FindProduct(self, ProductID, ExchangeID) -> list[dict]:
+        """在本地索引中查询品种, 指定的品种代码不在索引中时再向柜台查询"""
+        await self.LoadInstruments()
+        records = self.instruments.search_products(ProductID, ExchangeID)
+        if not records and ProductID and not self.instruments.is_pattern(ProductID):
+            self.instruments.add(products=await self.QryProduct(ExchangeID, ProductID))
+            records = self.instruments.search_products(ProductID, ExchangeID)
+        return records
 
     def QryExchange(self):
         req = tdapi.CThostFtdcQryExchangeField()
-        self.api.ReqQryExchange(req, 0)
+        return self._request(self.api.ReqQryExchange, req)
 
     def QryProduct(self, ExchangeID, ProductID):
         req = tdapi.CThostFtdcQryProductField()
         req.ExchangeID = ExchangeID
         req.ProductID = ProductID
-        self.api.ReqQryProduct(req, 0)
+        return self._request(self.api.ReqQryProduct, req)
 
     def QryPrice(self, ExchangeID, InstrumentID):
         req = tdapi.CThostFtdcQryDepthMarketDataField()
         req.ExchangeID = ExchangeID
         req.InstrumentID = InstrumentID
-        self.api.ReqQryDepthMarketData(req, 0)
+        return self._request(self.api.ReqQryDepthMarketData, req)
 
     def QryAccount(self):
         req = tdapi.CThostFtdcQryTradingAccountField()
         req.BrokerID = self.broker
         req.InvestorID = self.user
-        self.api.ReqQryTradingAccount(req, 0)
+        return self._request(self.api.ReqQryTradingAccount, req)
 
     def QryPosition(self, InstrumentID):
         req = tdapi.CThostFtdcQryInvestorPositionField()
         req.InvestorID = self.user
         req.BrokerID = self.broker
         req.InstrumentID = InstrumentID
-        self.api.ReqQryInvestorPosition(req, 0)
+        return self._request(self.api.ReqQryInvestorPosition, req)
 
     def QryPositionDetail(self, InstrumentID):
         req = tdapi.CThostFtdcQryInvestorPositionDetailField()
         req.InvestorID = self.user
         req.BrokerID = self.broker
         req.InstrumentID = InstrumentID
-        self.api.ReqQryInvestorPositionDetail(req, 0)
+        return self._request(self.api.ReqQryInvestorPositionDetail, req)
 
     def QryOrder(self, InstrumentID):
         req = tdapi.CThostFtdcQryOrderField()
         req.BrokerID = self.broker
         req.InvestorID = self.user
         req.InstrumentID = InstrumentID
-        self.api.ReqQryOrder(req, 0)
+        return self._request(self.api.ReqQryOrder, req)
 
     def QryTrade(self, InstrumentID):
         req = tdapi.CThostFtdcQryTradeField()
         req.BrokerID = self.broker
         req.InvestorID = self.user
         req.InstrumentID = InstrumentID
-        self.api.ReqQryTrade(req, 0)
+        return self._request(self.api.ReqQryTrade, req)
 
     def OnFrontConnected(self) -> "void":
-        print("OnFrontConnected")
+        self._print("OnFrontConnected")
 
         req = tdapi.CThostFtdcReqAuthenticateField()
         req.BrokerID = self.broker
         req.UserID = self.user
         req.AppID = self.appid
         req.AuthCode = self.authcode
-        self.api.ReqAuthenticate(req, 0)
+        self.api.ReqAuthenticate(req, self._next_request_id())
 
     def OnFrontDisconnected(self, nReason: int) -> "void":
-        print(f"OnFrontDisconnected.[nReason={nReason}]")
+        self._print(f"OnFrontDisconnected.[nReason={nReason}]")
+
+        # 断线后不会再收到未完成查询的响应
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future, rows in pending:
+            self._call_soon(self._resolve, future, rows, ConnectionError(f"front disconnected, nReason={nReason}"))
 
     def OnRspAuthenticate(
             self,
@@ -109,9 +403,10 @@ class CTPTelnet(tdapi.CThostFtdcTraderSpi):
     ):
         """客户端认证响应"""
         if pRspInfo and pRspInfo.ErrorID != 0:
-            print("认证失败：{}".format(pRspInfo.ErrorMsg))
-            exit(-1)
-        print("Authenticate succeed.")
+            self._print("认证失败：{}".format(pRspInfo.ErrorMsg))
+            self._set_login(False)
+            return
+        self._print("Authenticate succeed.")
 
         # 登录
         req = tdapi.CThostFtdcReqUserLoginField()
@@ -119,274 +414,681 @@ class CTPTelnet(tdapi.CThostFtdcTraderSpi):
         req.UserID = self.user
         req.Password = self.password
         req.UserProductInfo = "ctptelnet"
-        self.api.ReqUserLogin(req, 0)
+        self.api.ReqUserLogin(req, self._next_request_id())
 
     def OnRspUserLogin(self, pRspUserLogin: 'CThostFtdcRspUserLoginField', pRspInfo: 'CThostFtdcRspInfoField',
                        nRequestID: 'int', bIsLast: 'bool') -> "void":
         if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"Login failed. {pRspInfo.ErrorMsg}")
-            exit(-1)
-        print(f"Login succeed. TradingDay: {pRspUserLogin.TradingDay}")
-
-        semaphore.release()
+            self._print(f"Login failed. {pRspInfo.ErrorMsg}")
+            self._set_login(False)
+            return
+        self._print(f"Login succeed. TradingDay: {pRspUserLogin.TradingDay}")
+        self.trading_day = pRspUserLogin.TradingDay
+        if self.login.done() and self.monitor is not None:
+            # 断线期间的回报不会补发, 重新登录后重新查询持仓和资金
+            self._call_soon(self.monitor.start)
+        self._set_login(True)
 
     def OnRspQryInstrument(self, pInstrument: tdapi.CThostFtdcInstrumentField, pRspInfo: "CThostFtdcRspInfoField",
                            nRequestID: "int", bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryInstrument failed: {pRspInfo.ErrorMsg}")
-            return
-
+        record = None
         if pInstrument is not None:
-            print(
-                f"OnRspQryInstrument:{pInstrument.InstrumentID}, {pInstrument.InstrumentName}, {pInstrument.ExchangeID} "
-                f"ProductID={pInstrument.ProductID} "
-                f"VolumeMultiple={pInstrument.VolumeMultiple} "
-                f"PositionType={pInstrument.PositionType} "
-                f"PriceTick={pInstrument.PriceTick} "
-            )
-        if bIsLast == True:
-            print("Completed.")
+            record = {
+                "InstrumentID": pInstrument.InstrumentID,
+                "InstrumentName": pInstrument.InstrumentName,
+                "ExchangeID": pInstrument.ExchangeID,
+                "ProductID": pInstrument.ProductID,
+                "VolumeMultiple": pInstrument.VolumeMultiple,
+                "ProductClass": pInstrument.ProductClass,
+                "PositionType": pInstrument.PositionType,
+                "PriceTick": pInstrument.PriceTick,
+                "ExpireDate": pInstrument.ExpireDate,
+            }
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
 
     def OnRspQryExchange(self, pExchange: "CThostFtdcExchangeField", pRspInfo: "CThostFtdcRspInfoField",
                          nRequestID: "int", bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryExchange failed: {pRspInfo.ErrorMsg}")
-            return
-        print(f"OnRspQryExchange:{pExchange.ExchangeID},{pExchange.ExchangeName}")
-        if bIsLast == True:
-            print("Completed.")
+        record = None
+        if pExchange is not None:
+            record = {
+                "ExchangeID": pExchange.ExchangeID,
+                "ExchangeName": pExchange.ExchangeName,
+            }
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
 
     def OnRspQryProduct(self, pProduct: "CThostFtdcProductField", pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int",
                         bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryProduct failed: {pRspInfo.ErrorMsg}")
-            return
-        print(f"OnRspQryProduct:{pProduct.ProductID}, {pProduct.ProductName}, {pProduct.ExchangeID}")
-        if bIsLast == True:
-            print("Completed.")
+        record = None
+        if pProduct is not None:
+            record = {
+                "ProductID": pProduct.ProductID,
+                "ProductName": pProduct.ProductName,
+                "ExchangeID": pProduct.ExchangeID,
+                "ProductClass": pProduct.ProductClass,
+                "VolumeMultiple": pProduct.VolumeMultiple,
+                "PriceTick": pProduct.PriceTick,
+            }
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
+
+    @staticmethod
+    def _order_record(pOrder: tdapi.CThostFtdcOrderField) -> dict:
+        return {
+            "InstrumentID": pOrder.InstrumentID,
+            "ExchangeID": pOrder.ExchangeID,
+            "FrontID": pOrder.FrontID,
+            "SessionID": pOrder.SessionID,
+            "OrderRef": pOrder.OrderRef,
+            "OrderSysID": pOrder.OrderSysID,
+            "Direction": pOrder.Direction,
+            "CombOffsetFlag": pOrder.CombOffsetFlag,
+            "CombHedgeFlag": pOrder.CombHedgeFlag,
+            "LimitPrice": pOrder.LimitPrice,
+            "VolumeTotalOriginal": pOrder.VolumeTotalOriginal,
+            "VolumeTraded": pOrder.VolumeTraded,
+            "VolumeTotal": pOrder.VolumeTotal,
+            "OrderStatus": pOrder.OrderStatus,
+            "StatusMsg": pOrder.StatusMsg,
+        }
+
+    @staticmethod
+    def _trade_record(pTrade: tdapi.CThostFtdcTradeField) -> dict:
+        return {
+            "InstrumentID": pTrade.InstrumentID,
+            "ExchangeID": pTrade.ExchangeID,
+            "Direction": pTrade.Direction,
+            "TradeID": pTrade.TradeID,
+            "Price": pTrade.Price,
+            "Volume": pTrade.Volume,
+            "OffsetFlag": pTrade.OffsetFlag,
+            "HedgeFlag": pTrade.HedgeFlag,
+        }
 
     def OnRtnOrder(self, pOrder):
-        print(
+        if self.monitor is not None:
+            self._call_soon(self.monitor.on_order, self._order_record(pOrder))
+            return
+        self._print(
             f"OnRtnOrder:{pOrder.InstrumentID}, {pOrder.ExchangeID}, {pOrder.Direction}, {pOrder.LimitPrice},  {pOrder.VolumeTotalOriginal}, {pOrder.VolumeTraded}, {pOrder.OrderStatus}, {pOrder.StatusMsg}")
 
     def OnRtnTrade(self, pTrade):
-        print(
+        if self.monitor is not None:
+            self._call_soon(self.monitor.on_trade, self._trade_record(pTrade))
+            return
+        self._print(
             f"OnRtnTrade:{pTrade.InstrumentID}, {pTrade.ExchangeID}, {pTrade.Direction}, {pTrade.Price},  {pTrade.Volume}")
 
     def OnRspQryInvestorPosition(self, pInvestorPosition: tdapi.CThostFtdcInvestorPositionField,
                                  pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int", bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryInvestorPosition failed: {pRspInfo.ErrorMsg}")
-            return
-
+        record = None
         if pInvestorPosition is not None:
-            print(f"OnRspInvestorPosition:{pInvestorPosition.InstrumentID}, "
-                  f"PosiDirection={pInvestorPosition.PosiDirection}, "
-                  f"HedgeFlag={pInvestorPosition.HedgeFlag}, "
-                  f"PositionDate={pInvestorPosition.PositionDate}, "
-                  f"YdPosition={pInvestorPosition.YdPosition} "
-                  f"TodayPosition={pInvestorPosition.TodayPosition} "
-                  f"Position={pInvestorPosition.Position} ")
-
-        if bIsLast == True:
-            print("Completed.")
+            record = {
+                "InstrumentID": pInvestorPosition.InstrumentID,
+                "PosiDirection": pInvestorPosition.PosiDirection,
+                "HedgeFlag": pInvestorPosition.HedgeFlag,
+                "PositionDate": pInvestorPosition.PositionDate,
+                "YdPosition": pInvestorPosition.YdPosition,
+                "TodayPosition": pInvestorPosition.TodayPosition,
+                "Position": pInvestorPosition.Position,
+            }
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
 
     def OnRspQryInvestorPositionDetail(self, pInvestorPositionDetail: tdapi.CThostFtdcInvestorPositionDetailField,
                                        pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int",
                                        bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryInvestorPositionDetail failed: {pRspInfo.ErrorMsg}")
-            return
-
+        record = None
         if pInvestorPositionDetail is not None:
-            print(f"OnRspInvestorPosition:{pInvestorPositionDetail.InstrumentID}, "
-                  f"Direction={pInvestorPositionDetail.Direction} "
-                  f"HedgeFlag={pInvestorPositionDetail.HedgeFlag} "
-                  f"Volume={pInvestorPositionDetail.Volume} "
-                  f"OpenPrice={pInvestorPositionDetail.OpenPrice} "
-                  f"Margin={pInvestorPositionDetail.Margin} "
-                  f"CloseVolume={pInvestorPositionDetail.CloseVolume} "
-                  f"CloseAmount={pInvestorPositionDetail.CloseAmount} "
-                  f"OpenDate={pInvestorPositionDetail.OpenDate} "
-                  f"TradingDay={pInvestorPositionDetail.TradingDay} "
-                  )
-
-        if bIsLast == True:
-            print("Completed.")
+            record = {
+                "InstrumentID": pInvestorPositionDetail.InstrumentID,
+                "Direction": pInvestorPositionDetail.Direction,
+                "HedgeFlag": pInvestorPositionDetail.HedgeFlag,
+                "Volume": pInvestorPositionDetail.Volume,
+                "OpenPrice": pInvestorPositionDetail.OpenPrice,
+                "Margin": pInvestorPositionDetail.Margin,
+                "CloseVolume": pInvestorPositionDetail.CloseVolume,
+                "CloseAmount": pInvestorPositionDetail.CloseAmount,
+                "OpenDate": pInvestorPositionDetail.OpenDate,
+                "TradingDay": pInvestorPositionDetail.TradingDay,
+            }
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
 
     def OnRspQryOrder(self, pOrder: tdapi.CThostFtdcOrderField, pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int",
                       bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryOrder failed: {pRspInfo.ErrorMsg}")
-            return
-
+        record = None
         if pOrder is not None:
-            print(f"OnRspQryOrder: {InstrumentID} "
-                  f"ExchangeID={pOrder.ExchangeID} "
-                  f"Direction={pOrder.Direction} "
-                  f"LimitPrice={pOrder.LimitPrice} "
-                  f"VolumeTotalOriginal={pOrder.VolumeTotalOriginal} "
-                  f"OrderSysID={pOrder.OrderSysID} "
-                  f"OrderStatus={pOrder.OrderStatus} "
-                  f"VolumeTotal={pOrder.VolumeTotal} "
-                  )
-
-        if bIsLast == True:
-            print("Completed.")
+            record = self._order_record(pOrder)
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
 
     def OnRspQryTrade(self, pTrade: tdapi.CThostFtdcTradeField, pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int",
                       bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryTrade failed: {pRspInfo.ErrorMsg}")
-            return
-
+        record = None
         if pTrade is not None:
-            print(f"OnRspQryTrade: {InstrumentID} "
-                  f'Direction={pTrade.Direction} '
-                  f'TradeID={pTrade.TradeID} '
-                  f'Price={pTrade.Price} '
-                  f'Volume={pTrade.Volume} '
-                  f'OffsetFlag={pTrade.OffsetFlag} '
-                  f'HedgeFlag={pTrade.HedgeFlag} '
-                  )
-
-        if bIsLast == True:
-            print("Completed.")
+            record = self._trade_record(pTrade)
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
 
     def OnRspQryTradingAccount(self, pTradingAccount: tdapi.CThostFtdcTradingAccountField,
                                pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int", bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryTradingAccount failed: {pRspInfo.ErrorMsg}")
-            return
-
+        record = None
         if pTradingAccount is not None:
-            print(f"OnRspQryTradingAccount: "
-                  f"PreBalance={pTradingAccount.PreBalance} "
-                  f"PreMargin={pTradingAccount.PreMargin} "
-                  f"FrozenMargin={pTradingAccount.FrozenMargin} "
-                  f"Commission={pTradingAccount.Commission} "
-                  f"Available={pTradingAccount.Available} "
-                  f"Balance={pTradingAccount.Balance} "
-                  )
-
-        if bIsLast == True:
-            print("Completed.")
+            record = {
+                "PreBalance": pTradingAccount.PreBalance,
+                "PreMargin": pTradingAccount.PreMargin,
+                "FrozenMargin": pTradingAccount.FrozenMargin,
+                "Commission": pTradingAccount.Commission,
+                "Available": pTradingAccount.Available,
+                "Balance": pTradingAccount.Balance,
+                "CurrMargin": pTradingAccount.CurrMargin,
+                "CloseProfit": pTradingAccount.CloseProfit,
+                "PositionProfit": pTradingAccount.PositionProfit,
+            }
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
 
     def OnRspQryDepthMarketData(self, pDepthMarketData: tdapi.CThostFtdcDepthMarketDataField,
                                 pRspInfo: "CThostFtdcRspInfoField", nRequestID: "int", bIsLast: "bool") -> "void":
-        if pRspInfo is not None and pRspInfo.ErrorID != 0:
-            print(f"OnRspQryDepthMarketData failed: {pRspInfo.ErrorMsg}")
+        record = None
+        if pDepthMarketData is not None:
+            record = {
+                "InstrumentID": pDepthMarketData.InstrumentID,
+                "LastPrice": pDepthMarketData.LastPrice,
+                "PreSettlementPrice": pDepthMarketData.PreSettlementPrice,
+                "OpenPrice": pDepthMarketData.OpenPrice,
+                "HighestPrice": pDepthMarketData.HighestPrice,
+                "LowestPrice": pDepthMarketData.LowestPrice,
+                "Volume": pDepthMarketData.Volume,
+                "OpenInterest": pDepthMarketData.OpenInterest,
+                "UpperLimitPrice": pDepthMarketData.UpperLimitPrice,
+                "LowerLimitPrice": pDepthMarketData.LowerLimitPrice,
+                "BidPrice1": pDepthMarketData.BidPrice1,
+                "BidVolume1": pDepthMarketData.BidVolume1,
+                "AskPrice1": pDepthMarketData.AskPrice1,
+                "AskVolume1": pDepthMarketData.AskVolume1,
+            }
+        self._collect(nRequestID, record, pRspInfo, bIsLast)
+
+
+class Monitor(object):
+    """
+    持仓和资金监控
+        启动时查询一次持仓、报单和资金, 之后按成交回报更新持仓, 按报单回报更新挂单和平仓冻结;
+        资金中的手续费、保证金和盈亏由柜台计算, 有成交时按ACCOUNT_INTERVAL的间隔重新查询
+    """
+
+    # 有成交后重新查询资金的最小间隔(秒)
+    ACCOUNT_INTERVAL = 3.0
+    # 屏幕刷新的最小间隔(秒)
+    REFRESH_INTERVAL = 0.2
+    # 未完成的报单状态
+    ACTIVE_STATUS = (
+        tdapi.THOST_FTDC_OST_PartTradedQueueing,
+        tdapi.THOST_FTDC_OST_NoTradeQueueing,
+        tdapi.THOST_FTDC_OST_Unknown,
+    )
+    POSI_DIRECTIONS = {
+        tdapi.THOST_FTDC_PD_Net: "Net",
+        tdapi.THOST_FTDC_PD_Long: "Long",
+        tdapi.THOST_FTDC_PD_Short: "Short",
+    }
+
+    def __init__(self, ctptelnet: CTPTelnet):
+        self.ctptelnet = ctptelnet
+        self.positions = {}  # type: dict[tuple[str, str, str], dict]
+        self.orders = {}  # type: dict[tuple[int, int, str], dict]
+        self.account = {}  # type: dict
+        self.trades = 0
+        self.notices = deque(maxlen=5)
+        self._seeds = {}  # type: dict[str, asyncio.Future]
+        self._loaded = set()
+        self._account_refresh = None  # type: Optional[asyncio.Task]
+        self._last_account = 0.0
+        self._changed = asyncio.Event()
+
+    def start(self):
+        """查询持仓、报单和资金, 查询返回之前收到的回报已包含在查询结果中"""
+        self.positions = {}
+        self.orders = {}
+        self._loaded = set()
+        self._seeds = {
+            "positions": self.ctptelnet.QryPosition(""),
+            "orders": self.ctptelnet.QryOrder(""),
+            "account": self.ctptelnet.QryAccount(),
+        }
+        for name, query in self._seeds.items():
+            query.add_done_callback(lambda _, name=name: self._ready(name))
+        self._last_account = time.monotonic()
+
+    def _ready(self, name: str) -> bool:
+        """name的查询已返回时载入查询结果并返回True, 之后的回报在查询结果上增量更新"""
+        query = self._seeds.get(name)
+        if query is None or not query.done():
+            return False
+        if name not in self._loaded:
+            self._loaded.add(name)
+            if query.cancelled():
+                return False
+            if query.exception() is not None:
+                self.notice(f"query {name} failed: {query.exception()}")
+                return False
+            getattr(self, f"_load_{name}")(query.result())
+            self.changed()
+        return not query.cancelled() and query.exception() is None
+
+    def _load_positions(self, rows: list[dict]):
+        # 上期所和能源中心的今仓和昨仓分两条记录返回
+        for row in rows:
+            position = self._position(row["InstrumentID"], row["PosiDirection"], row["HedgeFlag"])
+            position["Position"] += row["Position"]
+            position["TodayPosition"] += row["TodayPosition"]
+
+    def _load_orders(self, rows: list[dict]):
+        for row in rows:
+            self._update_order(row)
+
+    def _load_account(self, rows: list[dict]):
+        if rows:
+            self.account = rows[0]
+
+    def _position(self, instrument_id: str, posi_direction: str, hedge_flag: str) -> dict:
+        key = (instrument_id, posi_direction, hedge_flag)
+        position = self.positions.get(key)
+        if position is None:
+            position = self.positions[key] = {"Position": 0, "TodayPosition": 0}
+        return position
+
+    def _update_order(self, order: dict):
+        key = (order["FrontID"], order["SessionID"], order["OrderRef"])
+        if order["OrderStatus"] in self.ACTIVE_STATUS:
+            self.orders[key] = order
+        else:
+            self.orders.pop(key, None)
+
+    def on_order(self, order: dict):
+        if self._ready("orders"):
+            self._update_order(order)
+            self.changed()
+
+    def on_trade(self, trade: dict):
+        self.trades += 1
+        if self._ready("positions"):
+            self.apply_trade(trade)
+        # 成交后资金变化, 限频重新查询
+        if self._account_refresh is None or self._account_refresh.done():
+            self._account_refresh = asyncio.ensure_future(self._refresh_account())
+        self.changed()
+
+    def apply_trade(self, trade: dict):
+        """按成交更新持仓: 开仓增加今仓; 平今减少今仓, 平昨减少昨仓, 平仓先平昨仓再平今仓"""
+        offset = trade["OffsetFlag"]
+        buy = trade["Direction"] == tdapi.THOST_FTDC_D_Buy
+        opening = offset == tdapi.THOST_FTDC_OF_Open
+        posi_direction = tdapi.THOST_FTDC_PD_Long if buy == opening else tdapi.THOST_FTDC_PD_Short
+        position = self._position(trade["InstrumentID"], posi_direction, trade["HedgeFlag"])
+        volume = trade["Volume"]
+        if opening:
+            position["Position"] += volume
+            position["TodayPosition"] += volume
             return
+        yesterday = position["Position"] - position["TodayPosition"]
+        position["Position"] -= volume
+        if offset == tdapi.THOST_FTDC_OF_CloseToday:
+            position["TodayPosition"] -= volume
+        elif offset != tdapi.THOST_FTDC_OF_CloseYesterday:
+            position["TodayPosition"] -= max(0, volume - yesterday)
 
-        if pDepthMarketData is not None:
-            print(f":OnRspQryDepthMarketData: {pDepthMarketData.InstrumentID} "
-                  f"LastPrice={pDepthMarketData.LastPrice} "
-                  f"PreSettlementPrice={pDepthMarketData.PreSettlementPrice} "
-                  f"OpenPrice={pDepthMarketData.OpenPrice} "
-                  f"HighestPrice={pDepthMarketData.HighestPrice} "
-                  f"LowestPrice={pDepthMarketData.LowestPrice} "
-                  f"Volume={pDepthMarketData.Volume} "
-                  f"OpenInterest={pDepthMarketData.OpenInterest} "
-                  f"UpperLimitPrice={pDepthMarketData.UpperLimitPrice} "
-                  f"LowerLimitPrice={pDepthMarketData.LowerLimitPrice} "
-                  f"BidPrice1={pDepthMarketData.BidPrice1} "
-                  f"BidVolume1={pDepthMarketData.BidVolume1} "
-                  f"AskPrice1={pDepthMarketData.AskPrice1} "
-                  f"AskVolume1={pDepthMarketData.AskVolume1} "
-                  )
-
-        if bIsLast == True:
-            print("Completed.")
+    async def _refresh_account(self):
+        await asyncio.sleep(max(0.0, self._last_account + self.ACCOUNT_INTERVAL - time.monotonic()))
+        self._last_account = time.monotonic()
+        try:
+            rows = await self.ctptelnet.QryAccount()
+        except (RspError, ConnectionError, RuntimeError) as e:
+            self.notice(f"query account failed: {e}")
+            return
+        self._load_account(rows)
+        self.changed()
+
+    def notice(self, text: str):
+        self.notices.append(f"{time.strftime('%H:%M:%S')} {text}")
+        self.changed()
+
+    def changed(self):
+        self._changed.set()
+
+    def position_rows(self) -> list[dict]:
+        # 未成交的平仓报单冻结的持仓
+        frozen = {}
+        for order in self.orders.values():
+            offset = order["CombOffsetFlag"][:1]
+            if offset and offset != tdapi.THOST_FTDC_OF_Open:
+                posi_direction = (tdapi.THOST_FTDC_PD_Short if order["Direction"] == tdapi.THOST_FTDC_D_Buy
+                                  else tdapi.THOST_FTDC_PD_Long)
+                key = (order["InstrumentID"], posi_direction, order["CombHedgeFlag"][:1])
+                frozen[key] = frozen.get(key, 0) + order["VolumeTotal"]
+
+        rows = []
+        for key, position in sorted(self.positions.items()):
+            if not position["Position"] and key not in frozen:
+                continue
+            instrument_id, posi_direction, hedge_flag = key
+            rows.append({
+                "InstrumentID": instrument_id,
+                "PosiDirection": self.POSI_DIRECTIONS.get(posi_direction, posi_direction),
+                "HedgeFlag": hedge_flag,
+                "Position": position["Position"],
+                "TodayPosition": position["TodayPosition"],
+                "YdPosition": position["Position"] - position["TodayPosition"],
+                "CloseFrozen": frozen.get(key, 0),
+            })
+        return rows
+
+    def render(self) -> str:
+        order_fields = ("InstrumentID", "Direction", "CombOffsetFlag", "LimitPrice", "VolumeTotalOriginal",
+                        "VolumeTraded", "OrderSysID", "OrderStatus")
+        orders = [{field: order[field] for field in order_fields} for order in self.orders.values()]
+        lines = [
+            f"ctptelnet watch  {self.ctptelnet.broker}/{self.ctptelnet.user}  "
+            f"TradingDay: {self.ctptelnet.trading_day}  {time.strftime('%H:%M:%S')}  Trades: {self.trades}",
+            "",
+            "Account",
+            render_table([self.account] if self.account else []),
+            "",
+            "Positions",
+            render_table(self.position_rows()),
+            "",
+            "Orders",
+            render_table(orders),
+            "",
+            *self.notices,
+        ]
+        return "\n".join(lines)
+
+    async def run(self):
+        """查询后按回报刷新屏幕, 直到按Ctrl+C退出"""
+        if os.name == "nt":
+            # 启用Windows控制台的ANSI转义序列
+            os.system("")
+        self.ctptelnet.monitor = self
+        self.start()
+        while True:
+            await self._changed.wait()
+            self._changed.clear()
+            # 清屏后从左上角重新输出
+            print("\x1b[H\x1b[2J" + self.render(), flush=True)
+            await asyncio.sleep(self.REFRESH_INTERVAL)
+
+
+class Command(object):
+    """
+    一行一个命令: <命令名或编号> [参数...]
+        参数按fields的顺序依次给出, 也可以写成 字段名=值, 省略的参数为空(查询全部)
+    """
+
+    def __init__(self, number: str, name: str, description: str, fields: tuple, query):
+        self.number = number
+        self.name = name
+        self.description = description
+        self.fields = fields
+        # query(ctptelnet, args) 返回等待查询结果的协程
+        self.query = query
+
+    def usage(self) -> str:
+        return " ".join([self.name, *(f"[{field}]" for field in self.fields)])
+
+
+COMMANDS = (
+    Command("1", "instrument", "query instrument",
+            ("InstrumentID", "ExchangeID", "ProductID", "ExpireDate", "ProductClass"),
+            lambda c, a: c.FindInstrument(a["InstrumentID"], a["ExchangeID"], a["ProductID"], a["ExpireDate"],
+                                          a["ProductClass"])),
+    Command("2", "exchange", "query exchange", (),
+            lambda c, a: c.QryExchange()),
+    Command("3", "product", "query product", ("ProductID", "ExchangeID"),
+            lambda c, a: c.FindProduct(a["ProductID"], a["ExchangeID"])),
+    Command("4", "price", "query price", ("InstrumentID", "ExchangeID"),
+            lambda c, a: c.QryPrice(a["ExchangeID"], a["InstrumentID"])),
+    Command("5", "account", "query account", (),
+            lambda c, a: c.QryAccount()),
+    Command("6", "position", "query position", ("InstrumentID",),
+            lambda c, a: c.QryPosition(a["InstrumentID"])),
+    Command("7", "detail", "query position detail", ("InstrumentID",),
+            lambda c, a: c.QryPositionDetail(a["InstrumentID"])),
+    Command("8", "order", "query order", ("InstrumentID",),
+            lambda c, a: c.QryOrder(a["InstrumentID"])),
+    Command("9", "trade", "query trade", ("InstrumentID",),
+            lambda c, a: c.QryTrade(a["InstrumentID"])),
+    Command("r", "refresh", "reload instruments", (),
+            lambda c, a: c.LoadInstruments(refresh=True)),
+    Command("q", "quit", "quit", (), None),
+)
+COMMAND_MAP = {key: command for command in COMMANDS for key in (command.number, command.name)}
+
+
+def split_commands(script: str) -> list[str]:
+    """按换行和 ; 拆分命令, 忽略空命令和 # 开头的注释行"""
+    commands = []
+    for line in script.splitlines():
+        if line.lstrip().startswith("#"):
+            continue
+        commands.extend(command.strip() for command in line.split(";") if command.strip())
+    return commands
+
+
+def parse_command(line: str) -> tuple[Command, dict[str, str]]:
+    """解析一行命令, 返回命令和以字段名为键的参数"""
+    name, *values = line.split()
+    command = COMMAND_MAP.get(name.lower())
+    if command is None:
+        raise ValueError(f"unknown command: {name}")
+    fields = {field.lower(): field for field in command.fields}
+    args = dict.fromkeys(command.fields, "")
+    # 按位置给出的参数单独计数, 字段名=值 不占位置
+    position = 0
+    for value in values:
+        key, sep, value = value.rpartition("=")
+        if sep:
+            if key.lower() not in fields:
+                raise ValueError(f"unknown argument: {key}, usage: {command.usage()}")
+            args[fields[key.lower()]] = value
+        elif position < len(command.fields):
+            args[command.fields[position]] = value
+            position += 1
+        else:
+            raise ValueError(f"too many arguments, usage: {command.usage()}")
+    return command, args
+
+
+def display_width(text: str) -> int:
+    """终端显示宽度, 中文等全角字符占两列"""
+    return sum(2 if unicodedata.east_asian_width(char) in "WF" else 1 for char in text)
+
+
+def render_table(rows: list[dict]) -> str:
+    """把查询结果渲染为一张对齐的表格"""
+    if not rows:
+        return "(no records)"
+    columns = list(rows[0])
+    cells = [[str(row[column]) for column in columns] for row in rows]
+    widths = [max(display_width(column), *(display_width(values[i]) for values in cells))
+              for i, column in enumerate(columns)]
+
+    def format_row(values):
+        return " | ".join(value + " " * (width - display_width(value))
+                          for value, width in zip(values, widths)).rstrip()
+
+    lines = [format_row(columns), "-+-".join("-" * width for width in widths)]
+    lines.extend(format_row(values) for values in cells)
+    lines.append(f"({len(rows)} rows)")
+    return "\n".join(lines)
+
+
+async def run_command(ctptelnet: CTPTelnet, command: Command, args: dict[str, str], line: str):
+    """执行一个查询命令, 完成后一次性打印该命令的结果表格"""
+    try:
+        rows = await command.query(ctptelnet, args)
+    except (RspError, ConnectionError, RuntimeError) as e:
+        print(f"> {line}\n{command.description} failed: {e}")
+        return
+    print(f"> {line}\n{render_table(rows)}")
 
 
 def print_commands():
     print("Commands:")
+    for command in COMMANDS:
+        print(f"{command.number}: {command.description:<24}{command.usage()}")
+    print("please enter a command name or number, followed by optional arguments, e.g. 'position rb2410'.")
 
-    print("{}: query instrument".format(command_query_instrument))
-    print("{}: query exchange".format(command_query_exchange))
-    print("{}: query product".format(command_query_product))
-    print("{}: query price".format(command_query_price))
-    print("{}: query account".format(command_query_account))
-    print("{}: query position".format(command_query_position))
-    print("{}: query position detail".format(command_query_position_detail))
-    print("{}: query order".format(command_query_order))
-    print("{}: query trade".format(command_query_trade))
-    print("{}: quit".format(command_quit))
-    print("please enter a command number.")
 
+def read_stdin(loop: asyncio.AbstractEventLoop) -> asyncio.Queue:
+    """
+    在守护线程中逐行读取标准输入, 读到的行放入返回的队列, 读完时放入空字符串;
+    退出时不需要等待阻塞在readline中的线程
+    """
+    lines = asyncio.Queue()
 
-if __name__ == '__main__':
-    if len(sys.argv) != 7:
-        print("Usage: {} host broker user password appid authcode".format(sys.argv[0]))
-        print("example: {} tcp://180.168.146.187:10130 9999 000001 888888 simnow_client_test 0000000000000000".format(
-            sys.argv[0]))
-        exit(0)
-
-    semaphore = threading.Semaphore(0)
-
-    host = sys.argv[1]
-    broker = sys.argv[2]
-    user = sys.argv[3]
-    password = sys.argv[4]
-    appid = sys.argv[5]
-    authcode = sys.argv[6]
-    ctptelnet = CTPTelnet(host, broker, user, password, appid, authcode)
-    ctptelnet.Run()
+    def read():
+        while True:
+            line = sys.stdin.readline()
+            try:
+                loop.call_soon_threadsafe(lines.put_nowait, line)
+            except RuntimeError:
+                # 事件循环已关闭
+                return
+            if not line:
+                return
+
+    threading.Thread(target=read, daemon=True).start()
+    return lines
 
-    # wait for login ok.
-    semaphore.acquire()
-
-    i = 1
-    command_query_instrument = str(i)
-    i = i + 1
-    command_query_exchange = str(i)
-    i = i + 1
-    command_query_product = str(i)
-    i = i + 1
-    command_query_price = str(i)
-    i = i + 1
-    command_query_account = str(i)
-    i = i + 1
-    command_query_position = str(i)
-    i = i + 1
-    command_query_position_detail = str(i)
-    i = i + 1
-    command_query_order = str(i)
-    i = i + 1
-    command_query_trade = str(i)
-    command_quit = 'q'
-
-    while True:
-        print_commands()
-        command = input("")
-        if command == command_query_instrument:
-            exchangeid = input("ExchangeID: (Default:All)")
-            productid = input("ProductID: (Default:All)")
-            instrumentid = input("InstrumentID: (Default:All)")
-            ctptelnet.QryInstrument(exchangeid, productid, instrumentid)
-        elif command == command_query_exchange:
-            ctptelnet.QryExchange()
-        elif command == command_query_product:
-            ExchangeId = input("ExchangeID: (Default:All)")
-            ProductId = input("ProductID: (Default:All)")
-            ctptelnet.QryProduct(ExchangeId, ProductId)
-        elif command == command_query_position:
-            InstrumentID = input("InstrumentID:(Default:All)")
-            ctptelnet.QryPosition(InstrumentID)
-        elif command == command_query_position_detail:
-            InstrumentID = input("InstrumentID:(Default:All)")
-            ctptelnet.QryPositionDetail(InstrumentID)
-        elif command == command_query_order:
-            InstrumentID = input("InstrumentID:(Default:All)")
-            ctptelnet.QryOrder(InstrumentID)
-        elif command == command_query_trade:
-            InstrumentID = input("InstrumentID:(Default:All)")
-            ctptelnet.QryTrade(InstrumentID)
-        elif command == command_query_price:
-            ExchangeId = input("ExchangeID: (Default:All)")
-            InstrumentID = input("InstrumentID:(Default:All)")
-            ctptelnet.QryPrice(ExchangeId, InstrumentID)
-        elif command == command_query_account:
-            ctptelnet.QryAccount()
-        elif command == command_quit:
+
+async def repl(ctptelnet: CTPTelnet):
+    """读取命令后立即发出查询并继续读取下一行, 不等待上一个查询完成"""
+    lines = read_stdin(asyncio.get_running_loop())
+    tasks = set()
+    print_commands()
+    running = True
+    while running:
+        line = await lines.get()
+        if not line:
             break
+        # 一行中可以用 ; 分隔多个命令
+        for line in split_commands(line):
+            if line in ("?", "help"):
+                print_commands()
+                continue
+            try:
+                command, args = parse_command(line)
+            except ValueError as e:
+                print(e)
+                continue
+            if command.query is None:
+                running = False
+                break
+            task = asyncio.create_task(run_command(ctptelnet, command, args, line))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    # 退出前等待已发出的查询完成
+    if tasks:
+        await asyncio.gather(*tasks)
+
+
+async def run_batch_command(ctptelnet: CTPTelnet, line: str) -> dict:
+    """执行批处理中的一个命令, 返回该命令的NDJSON记录"""
+    result = {"command": line}
+    start = time.monotonic()
+    try:
+        command, args = parse_command(line)
+        rows = await command.query(ctptelnet, args)
+    except RspError as e:
+        result.update(ok=False, error_id=e.error_id, error=e.error_msg)
+    except (ValueError, ConnectionError, RuntimeError) as e:
+        result.update(ok=False, error=str(e))
+    else:
+        result.update(ok=True, rows=rows)
+    result["elapsed"] = round(time.monotonic() - start, 3)
+    return result
+
+
+async def batch(ctptelnet: CTPTelnet, script: str, timeout: Optional[float] = None) -> bool:
+    """
+    在同一个会话中依次执行脚本中的全部命令, 查询按qry_rate连续发出,
+    每个命令输出一行json(NDJSON), 顺序与脚本相同; 全部成功时返回True
+        上一个命令输出后timeout秒内没有结果的命令输出超时错误, 不再等待
+    """
+    tasks = []
+    for line in split_commands(script):
+        if COMMAND_MAP.get(line.split()[0].lower()) is COMMAND_MAP["quit"]:
+            break
+        tasks.append((line, asyncio.create_task(run_batch_command(ctptelnet, line))))
+
+    ok = True
+    for line, task in tasks:
+        try:
+            result = await asyncio.wait_for(task, timeout)
+        except asyncio.TimeoutError:
+            result = {"command": line, "ok": False, "error": f"no response in {timeout}s"}
+        print(json.dumps(result, ensure_ascii=False), flush=True)
+        ok = ok and result["ok"]
+    return ok
+
+
+async def main(ctptelnet: CTPTelnet, script: Optional[str] = None, watch: bool = False,
+               timeout: Optional[float] = None) -> bool:
+    ctptelnet.loop = asyncio.get_running_loop()
+    ctptelnet.Run()
+    try:
+        # wait for login ok.
+        try:
+            ok = await asyncio.wait_for(asyncio.wrap_future(ctptelnet.login), timeout)
+            error = "login failed"
+        except asyncio.TimeoutError:
+            ok, error = False, f"no response in {timeout}s"
+        if not ok:
+            if script is not None:
+                print(json.dumps({"command": "login", "ok": False, "error": error}), flush=True)
+            else:
+                print(error, file=ctptelnet.log)
+            return False
+
+        if watch:
+            await Monitor(ctptelnet).run()
+        if script is not None:
+            return await batch(ctptelnet, script, timeout)
+        await repl(ctptelnet)
+        return True
+    finally:
+        ctptelnet.Release()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="ctptelnet",
+        epilog="example: %(prog)s tcp://180.168.146.187:10130 9999 000001 888888 simnow_client_test 0000000000000000")
+    parser.add_argument("host")
+    parser.add_argument("broker")
+    parser.add_argument("user")
+    parser.add_argument("password")
+    parser.add_argument("appid")
+    parser.add_argument("authcode")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--batch", metavar="FILE",
+                      help="批处理模式, 依次执行FILE(- 为标准输入)中以换行或 ; 分隔的命令, 每个命令输出一行json")
+    mode.add_argument("--watch", action="store_true", help="监控模式, 按成交和报单回报实时刷新持仓、挂单和资金, Ctrl+C退出")
+    parser.add_argument("--rate", type=float, default=1.0, help="每秒最多发送的查询数, 0为不限制, 默认1")
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="等待登录和批处理中每个命令结果的最长秒数, 默认60")
+    args = parser.parse_args()
+
+    script = None
+    if args.batch == "-":
+        script = sys.stdin.read()
+    elif args.batch is not None:
+        with open(args.batch, encoding="utf-8") as f:
+            script = f.read()
+
+    ctptelnet = CTPTelnet(args.host, args.broker, args.user, args.password, args.appid, args.authcode, args.rate)
+    if script is not None:
+        # 标准输出只输出NDJSON
+        ctptelnet.log = sys.stderr
+    try:
+        if not asyncio.run(main(ctptelnet, script, args.watch, args.timeout)):
+            exit(-1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,43 @@
+import pytest
+from ctptelnet import parse_command
+
+
+def testParsePositional():
+    command, args = parse_command("instrument rb* SHFE")
+    assert command.name == "instrument"
+    assert args["InstrumentID"] == "rb*"
+    assert args["ExchangeID"] == "SHFE"
+    assert args["ProductID"] == ""
+
+
+def testParseMixed():
+    # 字段名=值 不占位置, 其后的位置参数仍从第一个字段开始
+    command, args = parse_command("instrument ExchangeID=SHFE rb*")
+    assert args["InstrumentID"] == "rb*"
+    assert args["ExchangeID"] == "SHFE"
+
+    command, args = parse_command("4 exchangeid=SHFE rb2410")
+    assert command.name == "price"
+    assert args == {"InstrumentID": "rb2410", "ExchangeID": "SHFE"}
+
+    command, args = parse_command("instrument rb* productid=rb SHFE")
+    assert args["InstrumentID"] == "rb*"
+    assert args["ProductID"] == "rb"
+    assert args["ExchangeID"] == "SHFE"
+
+
+def testParseErrors():
+    with pytest.raises(ValueError):
+        parse_command("unknown")
+    with pytest.raises(ValueError):
+        parse_command("price Volume=1")
+    with pytest.raises(ValueError):
+        parse_command("position rb2410 ag2412")
+    with pytest.raises(ValueError):
+        parse_command("position InstrumentID=rb2410 rb2410 ag2412")
+
+
+if __name__ == "__main__":
+    testParsePositional()
+    testParseMixed()
+    testParseErrors()